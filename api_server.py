@@ -0,0 +1,132 @@
+"""
+HTTP API for the private docs agents, one warmed agent and chroma client per worker process.
+
+    uvicorn api_server:app --host 0.0.0.0 --port 8000 --workers 4
+
+Environment: GROQ_API_KEY, MAX_CONCURRENT_REQUESTS (per worker, default 8),
+QUEUE_TIMEOUT (seconds a request waits for a free slot before a 503, default 30),
+GROQ_REQUESTS_PER_MINUTE / GROQ_TOKENS_PER_MINUTE (per worker limits, default 30 / 6000),
+GROQ_BASE_URL (e.g. a local stub from benchmarks/groq_stub_server.py),
+PRIVATE_DOCS_COLLECTIONS (comma separated persist_path:collection_name shards, default ./docsdb2:private_docs).
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from custom_agents.private_docs_agent import private_docs_agent
+from custom_agents.multiquery_private_docs_agent import multiquery_private_docs_agent
+from custom_agents.startup_timer import StartupTimer
+from custom_agents.llm_scheduler import make_groq_llm, scheduler_from_env
+
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "8"))
+QUEUE_TIMEOUT = float(os.environ.get("QUEUE_TIMEOUT", "30"))
+COLLECTIONS = [tuple(entry.strip().rsplit(":", 1)) for entry in os.environ.get("PRIVATE_DOCS_COLLECTIONS", "./docsdb2:private_docs").split(",")]
+
+
+class Question(BaseModel):
+    question: str
+
+
+class Answer(BaseModel):
+    answer: str
+
+
+@asynccontextmanager
+async def lifespan(app):
+    scheduler = scheduler_from_env()
+    llm = make_groq_llm(os.environ['GROQ_API_KEY'], model_name="llama3-70b-8192", scheduler=scheduler,
+                        base_url=os.environ.get("GROQ_BASE_URL"))
+    startup_timer = StartupTimer()
+    expert = private_docs_agent(llm, collections=COLLECTIONS, speculative_retrieval=True, startup_timer=startup_timer)
+    expert.warm_up(startup_timer)
+    app.state.private_docs_agent = expert
+    app.state.multiquery_agent = multiquery_private_docs_agent(llm, private_docs_expert=expert)
+    app.state.startup_timer = startup_timer
+    app.state.scheduler = scheduler
+    app.state.slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    yield
+
+
+app = FastAPI(title="Private multidoc chat", lifespan=lifespan)
+
+
+async def acquire_slot():
+    try:
+        await asyncio.wait_for(app.state.slots.acquire(), timeout=QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Too many concurrent requests, retry later")
+
+
+def slot_releaser():
+    """
+    Releases the acquired slot on its first call only, so every path that may end a request can call it
+    """
+    released = False
+
+    async def release():
+        nonlocal released
+        if not released:
+            released = True
+            app.state.slots.release()
+    return release
+
+
+def initial_state(question):
+    return {"question": question, "generation_log": "Step: Init agent\n"}
+
+
+@app.post("/ask", response_model=Answer)
+async def ask(question: Question):
+    await acquire_slot()
+    try:
+        # agents are synchronous, run them off the event loop
+        answer = await run_in_threadpool(app.state.private_docs_agent.ask_question, initial_state(question.question))
+    finally:
+        app.state.slots.release()
+    return Answer(answer=answer)
+
+
+@app.post("/ask/multiquery", response_model=Answer)
+async def ask_multiquery(question: Question):
+    await acquire_slot()
+    try:
+        answer = await run_in_threadpool(app.state.multiquery_agent.ask_question, initial_state(question.question))
+    finally:
+        app.state.slots.release()
+    return Answer(answer=answer)
+
+
+@app.post("/ask/stream")
+async def ask_stream(question: Question):
+    await acquire_slot()
+    release = slot_releaser()
+    tokens = app.state.private_docs_agent.ask_question_stream(initial_state(question.question))
+
+    async def stream():
+        # the slot is held until the last token is sent
+        try:
+            async for token in iterate_in_threadpool(tokens):
+                yield token
+        finally:
+            await release()
+
+    # the background task runs after the response even when the client left before the body was iterated
+    return StreamingResponse(stream(), media_type="text/plain; charset=utf-8", background=BackgroundTask(release))
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "startup": dict(app.state.startup_timer.phases), "llm_scheduler": app.state.scheduler.stats()}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("api_server:app", host="0.0.0.0", port=int(os.environ.get("PORT", "8000")),
+                workers=int(os.environ.get("WEB_CONCURRENCY", "1")))
@@ -0,0 +1,87 @@
+"""
+End-to-end latency and throughput of private_docs_agent without Groq.
+
+The LLM is the deterministic ScriptedChatModel, so what is measured is the agent's own cost: LangGraph
+dispatch, prompt rendering, query embedding with the local embedder, chroma queries and context building.
+Each path of the graph is run separately:
+    generate_answer   analyze -> query -> reflect -> generate
+    add_more_context  analyze -> query -> reflect -> add_more_context -> analyze -> query -> ... -> generate
+    reanalize_doc     analyze -> query -> reflect -> reanalize_doc -> analyze -> query -> ... -> generate
+Answer and LLM caches are off; agent debug prints are silenced while measuring. With --speculative-retrieval
+init_agent retrieves on the question and the first analyze step is skipped; with --speculative-generation the
+answer is drafted while reflect runs.
+
+Run from the repository root:
+    python -m benchmarks.agent_end_to_end
+    python -m benchmarks.agent_end_to_end --llm-latency 0.5 --threads 8
+    python -m benchmarks.agent_end_to_end --llm-latency 0.5 --speculative-retrieval
+"""
+import argparse
+import contextlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_queries, make_benchmark_agent, percentile, print_table
+from benchmarks.scripted_llm import ScriptedChatModel
+
+PATHS = ["generate_answer", "add_more_context", "reanalize_doc"]
+
+
+def make_scripted_agent(reflect_choice="generate_answer", llm_latency=0.0, **kwargs):
+    """
+    private_docs_agent on a ScriptedChatModel, with the embedding cache also kept in memory only
+    """
+    kwargs.setdefault("embedding_cache_path", None)
+    llm = ScriptedChatModel(reflect_choice=reflect_choice, latency=llm_latency)
+    return make_benchmark_agent(llm, **kwargs), llm
+
+
+def initial_state(question):
+    return {"question": question, "generation_log": "Step: Init agent\n", "observations": ""}
+
+
+def run_path(path, questions, llm_latency, threads, **agent_options):
+    agent, llm = make_scripted_agent(path, llm_latency, **agent_options)
+    agent.warm_up()
+    with contextlib.redirect_stdout(io.StringIO()):
+        # one untimed pass so every path sees the same warm embedding cache
+        agent.ask_question(initial_state(questions[0]))
+        llm.counts.clear()
+
+        latencies = []
+        for question in questions:
+            start = time.perf_counter()
+            agent.ask_question(initial_state(question))
+            latencies.append(time.perf_counter() - start)
+        calls_per_question = sum(llm.counts.values()) / len(questions)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda question: agent.ask_question(initial_state(question)), questions))
+        concurrent_seconds = time.perf_counter() - start
+
+    return [path, len(questions), f"{calls_per_question:.1f}",
+            f"{percentile(latencies, 50) * 1000:.1f}", f"{percentile(latencies, 95) * 1000:.1f}",
+            f"{len(questions) / sum(latencies):.1f}", f"{len(questions) / concurrent_seconds:.1f}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paths", nargs="+", default=PATHS, choices=PATHS)
+    parser.add_argument("--limit", type=int, help="only the first N queries")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent questions for the throughput run")
+    parser.add_argument("--speculative-retrieval", action="store_true", help="retrieve on the question before the first LLM call")
+    parser.add_argument("--speculative-generation", action="store_true", help="draft the answer in parallel with reflect")
+    args = parser.parse_args()
+
+    questions = [entry["query"] for entry in load_queries()][:args.limit]
+    rows = [run_path(path, questions, args.llm_latency, args.threads, speculative_retrieval=args.speculative_retrieval,
+                    speculative_generation=args.speculative_generation)
+            for path in args.paths]
+    print_table(["path", "questions", "llm calls/q", "p50 ms", "p95 ms", "q/s", f"q/s x{args.threads}"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import json
+import os
+import time
+
+import numpy as np
+
+QUERIES_PATH = os.path.join(os.path.dirname(__file__), "queries.json")
+
+
+def load_queries(path=QUERIES_PATH):
+    """
+    Labelled query set, each entry has a 'query' and the 'relevant_files' that should be retrieved for it
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if len(values) else float("nan")
+
+
+def file_recall(metadatas, relevant_files):
+    """
+    Fraction of the relevant files that appear among the retrieved chunks
+    """
+    retrieved = {meta["file_name"] for meta in metadatas}
+    return len(retrieved & set(relevant_files)) / len(relevant_files)
+
+
+def run_recall(agent, queries, k, label):
+    """
+    Retrieve every labelled query one at a time with the agent as configured, the queries are embedded once
+    beforehand so the embedder does not count in the latency
+
+    Returns:
+        list: table row with label, mean file recall, hit rate (any relevant file found), p50 and p99 latency in ms
+    """
+    agent.embedding_cache.embed([entry["query"] for entry in queries])
+    latencies, recalls = [], []
+    for entry in queries:
+        start = time.perf_counter()
+        result = agent.retrieve_batch([entry["query"]], n_results=k)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(file_recall(result["metadatas"], entry["relevant_files"]))
+    return [
+        label,
+        f"{sum(recalls) / len(recalls):.3f}",
+        f"{sum(recall > 0 for recall in recalls) / len(recalls):.3f}",
+        f"{percentile(latencies, 50):.1f}",
+        f"{percentile(latencies, 99):.1f}",
+    ]
+
+
+def make_benchmark_agent(llm, **kwargs):
+    """
+    private_docs_agent on the given LLM with the answer and LLM caches and the trace file off, unless kwargs set them
+    """
+    from custom_agents.private_docs_agent import private_docs_agent
+
+    kwargs.setdefault("answer_cache_threshold", None)
+    kwargs.setdefault("llm_cache_path", None)
+    # traces stay in memory, benchmark runs must not end up in the production trace file
+    kwargs.setdefault("trace_path", None)
+    return private_docs_agent(llm, **kwargs)
+
+
+def make_retrieval_agent(**kwargs):
+    """
+    private_docs_agent for retrieval only benchmarks, the LLM is a placeholder that is never called
+    """
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+    return make_benchmark_agent(FakeListChatModel(responses=[""]), **kwargs)
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+    for row in [headers] + rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
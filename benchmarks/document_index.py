@@ -0,0 +1,33 @@
+"""
+Recall and latency of flat chunk search against two-stage search (top files by centroid, then their chunks).
+
+Run from the repository root:
+    python -m benchmarks.document_index --k 5 --top-files 4 8 16
+"""
+import argparse
+
+from benchmarks.common import load_queries, make_retrieval_agent, print_table, run_recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=5, help="chunks retrieved per query")
+    parser.add_argument("--top-files", type=int, nargs="+", default=[4, 8, 16], help="files kept by the first stage")
+    parser.add_argument("--centroids-per-file", type=int, default=3)
+    args = parser.parse_args()
+
+    queries = load_queries()
+    agent = make_retrieval_agent(top_files=max(args.top_files), centroids_per_file=args.centroids_per_file)
+    document_index = agent.document_index
+    print(f"{len(document_index.file_names)} files, {len(document_index.centroids)} centroids")
+
+    rows = []
+    for top_files in [None] + args.top_files:
+        agent.document_index = document_index if top_files else None
+        agent.top_files = top_files
+        rows.append(run_recall(agent, queries, args.k, f"top {top_files} files" if top_files else "flat"))
+    print_table(["mode", f"file_recall@{args.k}", f"hit_rate@{args.k}", "p50_ms", "p99_ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Local stand-in for the Groq chat completions endpoint, to exercise the LLM scheduler without a key or quota.
+
+It enforces a requests-per-minute limit over a sliding window and answers 429 with retry-after
+above it, fails a fraction of the remaining calls at random with 429 or 503, and sleeps a fixed
+latency per call. Streaming requests are answered as server-sent events.
+
+Prompts are answered by benchmarks.scripted_llm, so the agents' decision chains get the JSON they parse
+and the whole app can run against the stub; --reflect-choice picks the path through the graph.
+
+Run from the repository root:
+    python -m benchmarks.groq_stub_server --port 8099 --rpm 30 --failure-rate 0.1
+and point the app at it with GROQ_BASE_URL=http://127.0.0.1:8099
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from benchmarks.scripted_llm import ScriptedChatModel
+
+
+def create_app(rpm=30, failure_rate=0.0, latency=0.05, reflect_choice="generate_answer"):
+    app = FastAPI(title="Groq stub")
+    responder = ScriptedChatModel(reflect_choice=reflect_choice)
+    app.state.requests = collections.deque()
+    app.state.counts = collections.Counter()
+
+    def over_limit():
+        now = time.monotonic()
+        window = app.state.requests
+        while window and now - window[0] > 60:
+            window.popleft()
+        if len(window) >= rpm:
+            return 60 - (now - window[0])
+        window.append(now)
+        return None
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        wait = over_limit()
+        if wait is not None:
+            app.state.counts["rate_limited"] += 1
+            return JSONResponse({"error": {"message": "rate limit", "type": "requests", "code": "rate_limit_exceeded"}},
+                                status_code=429, headers={"retry-after": f"{wait:.2f}"})
+        if random.random() < failure_rate:
+            status = random.choice([429, 503])
+            app.state.counts[f"injected_{status}"] += 1
+            return JSONResponse({"error": {"message": "injected failure", "type": "stub"}}, status_code=status)
+
+        app.state.counts["ok"] += 1
+        await asyncio.sleep(latency)
+        messages = body.get("messages") or [{}]
+        answer = responder.respond(str(messages[-1].get("content", "")))
+        prompt_tokens = sum(len(str(message.get("content", ""))) // 4 + 1 for message in body.get("messages", []))
+        completion_tokens = len(answer) // 4 + 1
+        base = {"id": f"stub-{app.state.counts['ok']}", "created": int(time.time()), "model": body.get("model", "stub")}
+        if body.get("stream"):
+            return StreamingResponse(stream_answer(base, answer), media_type="text/event-stream")
+        return {
+            **base,
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop", "logprobs": None}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return dict(app.state.counts)
+
+    return app
+
+
+async def stream_answer(base, answer):
+    for word in answer.split(" "):
+        chunk = {**base, "object": "chat.completion.chunk",
+                 "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--rpm", type=int, default=30, help="requests per minute before answering 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of calls failed at random")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per completion")
+    parser.add_argument("--reflect-choice", default="generate_answer", choices=["generate_answer", "add_more_context", "reanalize_doc"])
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.rpm, args.failure_rate, args.latency, args.reflect_choice), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Recall and latency of the HNSW index of the private_docs collection for a sweep of hnsw:M, construction_ef and search_ef.
+
+Ground truth is a brute-force search over the embeddings stored in the collection. Indexes are built with
+hnswlib (the library chroma uses underneath) so one build serves every search_ef of the sweep.
+
+Run from the repository root:
+    python -m benchmarks.hnsw_tuning --M 8 16 32 --construction-ef 100 200 --search-ef 10 50 100
+    python -m benchmarks.hnsw_tuning --rebuild 16 200 50 --target-collection private_docs_tuned
+"""
+import argparse
+import time
+
+import numpy as np
+
+from custom_agents.retrievers import import_chromadb
+
+chromadb = import_chromadb()
+import hnswlib
+
+from benchmarks.common import percentile, print_table
+
+
+def load_collection(collection, batch_size=1000):
+    data = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+    for offset in range(0, collection.count(), batch_size):
+        batch = collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+        for key in data:
+            data[key].extend(batch[key])
+    data["embeddings"] = np.asarray(data["embeddings"], dtype=np.float32)
+    return data
+
+
+def brute_force(embeddings, queries, k, space):
+    """
+    Exact top-k labels of every query, using the same metric as the HNSW index
+    """
+    if space == "cosine":
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        distances = -queries @ embeddings.T
+    elif space == "ip":
+        distances = -queries @ embeddings.T
+    else:
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ embeddings.T + (embeddings ** 2).sum(axis=1)[None, :]
+    return np.argsort(distances, axis=1)[:, :k]
+
+
+def sweep(embeddings, queries, truth, k, space, Ms, construction_efs, search_efs):
+    rows = []
+    for M in Ms:
+        for construction_ef in construction_efs:
+            index = hnswlib.Index(space=space, dim=embeddings.shape[1])
+            start = time.perf_counter()
+            index.init_index(max_elements=len(embeddings), ef_construction=construction_ef, M=M)
+            index.add_items(embeddings, np.arange(len(embeddings)))
+            build_seconds = time.perf_counter() - start
+
+            for search_ef in search_efs:
+                index.set_ef(max(search_ef, k))
+                latencies, recalls = [], []
+                for query, expected in zip(queries, truth):
+                    start = time.perf_counter()
+                    labels, _distances = index.knn_query(query, k=k)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    recalls.append(len(set(labels[0]) & set(expected)) / k)
+                rows.append([M, construction_ef, search_ef, f"{np.mean(recalls):.4f}",
+                             f"{percentile(latencies, 50):.3f}", f"{percentile(latencies, 99):.3f}", f"{build_seconds:.1f}"])
+    return rows
+
+
+def rebuild(client, data, target_name, space, M, construction_ef, search_ef, batch_size=1000):
+    """
+    Copy the collection into target_name with the chosen HNSW settings, reusing the stored embeddings
+    """
+    target = client.create_collection(target_name, metadata={
+        "hnsw:space": space,
+        "hnsw:M": M,
+        "hnsw:construction_ef": construction_ef,
+        "hnsw:search_ef": search_ef,
+    })
+    for offset in range(0, len(data["ids"]), batch_size):
+        end = offset + batch_size
+        target.add(
+            ids=data["ids"][offset:end],
+            documents=data["documents"][offset:end],
+            metadatas=data["metadatas"][offset:end],
+            embeddings=data["embeddings"][offset:end].tolist(),
+        )
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--persist-path", default="./docsdb2")
+    parser.add_argument("--collection", default="private_docs")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--num-queries", type=int, default=200, help="stored chunks sampled as queries")
+    parser.add_argument("--M", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[10, 20, 50, 100])
+    parser.add_argument("--rebuild", type=int, nargs=3, metavar=("M", "CONSTRUCTION_EF", "SEARCH_EF"),
+                        help="rebuild the collection with these settings instead of sweeping")
+    parser.add_argument("--target-collection", default="private_docs_tuned")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=args.persist_path)
+    collection = client.get_collection(args.collection)
+    space = (collection.metadata or {}).get("hnsw:space", "l2")
+    print(f"#hnsw collection metadata: {collection.metadata}")
+    data = load_collection(collection)
+    embeddings = data["embeddings"]
+    print(f"#hnsw {len(embeddings)} embeddings of dimension {embeddings.shape[1]}, space {space}")
+
+    if args.rebuild:
+        M, construction_ef, search_ef = args.rebuild
+        target = rebuild(client, data, args.target_collection, space, M, construction_ef, search_ef)
+        print(f"#hnsw rebuilt {target.count()} chunks into {args.target_collection} with {target.metadata}")
+        return
+
+    # stored chunks with a little noise, so queries are realistic neighbours rather than exact copies
+    rng = np.random.default_rng(args.seed)
+    sample = rng.choice(len(embeddings), size=min(args.num_queries, len(embeddings)), replace=False)
+    queries = embeddings[sample] + rng.normal(0, 0.01, size=(len(sample), embeddings.shape[1])).astype(np.float32)
+    truth = brute_force(embeddings, queries, args.k, space)
+
+    rows = sweep(embeddings, queries, truth, args.k, space, args.M, args.construction_ef, args.search_ef)
+    print_table(["M", "construction_ef", "search_ef", f"recall@{args.k}", "p50_ms", "p99_ms", "build_s"], rows)
+
+
+if __name__ == "__main__":
+    main()
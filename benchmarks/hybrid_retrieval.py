@@ -0,0 +1,29 @@
+"""
+Side by side latency and recall of pure vector search and hybrid BM25 + vector search over private_docs.
+
+Run from the repository root:
+    python -m benchmarks.hybrid_retrieval --k 5
+"""
+import argparse
+
+from benchmarks.common import load_queries, make_retrieval_agent, print_table, run_recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=5, help="chunks retrieved per query")
+    parser.add_argument("--fetch-k", type=int, default=20, help="candidates fused from each ranking")
+    args = parser.parse_args()
+
+    queries = load_queries()
+    agent = make_retrieval_agent(hybrid=True, rerank_fetch_k=args.fetch_k)
+
+    rows = []
+    for hybrid in (False, True):
+        agent.hybrid = hybrid
+        rows.append(run_recall(agent, queries, args.k, "hybrid" if hybrid else "vector"))
+    print_table(["mode", f"file_recall@{args.k}", f"hit_rate@{args.k}", "p50_ms", "p99_ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+LLM calls, tokens and wall time per question of the default (reflect then analyze) and fused
+(plan_next_step) topologies of private_docs_agent, on every reflect path of the scripted LLM.
+
+Tokens are the estimate of custom_agents.context_builder (about 4 characters per token); with
+--llm-latency each call also sleeps, which stands in for the model's time.
+
+Run from the repository root:
+    python -m benchmarks.planner_topology --llm-latency 0.5
+    python -m benchmarks.planner_topology --speculative-retrieval --limit 5
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from benchmarks.agent_end_to_end import PATHS, initial_state, make_scripted_agent
+from benchmarks.common import load_queries, percentile, print_table
+
+
+def run(topology, path, questions, llm_latency, **agent_options):
+    agent, llm = make_scripted_agent(path, llm_latency, topology=topology, **agent_options)
+    agent.warm_up()
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for question in questions:
+            start = time.perf_counter()
+            agent.ask_question(initial_state(question))
+            latencies.append(time.perf_counter() - start)
+    n = len(questions)
+    return [topology, path, f"{sum(llm.counts.values()) / n:.1f}",
+            f"{llm.tokens['prompt_tokens'] / n:.0f}", f"{llm.tokens['completion_tokens'] / n:.0f}",
+            f"{percentile(latencies, 50) * 1000:.1f}", f"{sum(latencies) / n * 1000:.1f}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paths", nargs="+", default=PATHS, choices=PATHS)
+    parser.add_argument("--limit", type=int, help="only the first N queries")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument("--speculative-retrieval", action="store_true", help="retrieve on the question before the first LLM call")
+    args = parser.parse_args()
+
+    questions = [entry["query"] for entry in load_queries()][:args.limit]
+    rows = [run(topology, path, questions, args.llm_latency, speculative_retrieval=args.speculative_retrieval)
+            for path in args.paths for topology in ("default", "fused")]
+    print_table(["topology", "path", "llm calls/q", "prompt tok/q", "completion tok/q", "p50 ms", "mean ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Latency and memory of the chroma retriever against NumPy exact-search exports of the same collection.
+
+Each backend runs in its own process so its peak RSS is not mixed with the others. Query embeddings are
+computed once up front, so the embedder counts in no backend.
+
+Run from the repository root:
+    python -m benchmarks.retriever_backends --export ./docsdb2_cache/numpy_float32 --dtype float32
+    python -m benchmarks.retriever_backends --export ./docsdb2_cache/numpy_int8 --dtype int8
+    python -m benchmarks.retriever_backends --numpy ./docsdb2_cache/numpy_float32 ./docsdb2_cache/numpy_int8
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import load_queries, percentile, print_table
+
+
+def run_worker(backend, embeddings_path, k, repeats):
+    start = time.perf_counter()
+    if backend == "chroma":
+        from custom_agents.retrievers import ChromaRetriever
+        retriever = ChromaRetriever("./docsdb2", "private_docs")
+    else:
+        from custom_agents.retrievers import NumpyRetriever
+        retriever = NumpyRetriever(backend)
+    load_seconds = time.perf_counter() - start
+
+    query_embeddings = np.load(embeddings_path).tolist()
+    # first query pays for loading the index pages, it is reported apart
+    start = time.perf_counter()
+    retriever.query(query_embeddings[:1], n_results=k)
+    first_ms = (time.perf_counter() - start) * 1000
+
+    latencies, ids = [], []
+    for _ in range(repeats):
+        ids = []
+        for embedding in query_embeddings:
+            start = time.perf_counter()
+            result = retriever.query([embedding], n_results=k)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            ids.append(result["ids"])
+
+    print(json.dumps({
+        "load_s": load_seconds,
+        "first_ms": first_ms,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "ids": ids,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--export", help="export private_docs into this folder for NumpyRetriever and exit")
+    parser.add_argument("--dtype", choices=["float32", "int8"], default="float32")
+    parser.add_argument("--numpy", nargs="*", default=[], help="exported folders to benchmark against chroma")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--embeddings", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.embeddings, args.k, args.repeats)
+        return
+
+    if args.export:
+        from custom_agents.retrievers import ChromaRetriever, export_collection
+        export_collection(ChromaRetriever("./docsdb2", "private_docs"), args.export, args.dtype)
+        print(f"#backends exported private_docs to {args.export} as {args.dtype}")
+        return
+
+    from custom_agents.embedder import load_embedding_function
+    queries = [entry["query"] for entry in load_queries()]
+    embeddings = np.asarray(load_embedding_function()(queries), dtype=np.float32)
+
+    rows = []
+    reference_ids = None
+    with tempfile.TemporaryDirectory() as tmp:
+        embeddings_path = os.path.join(tmp, "queries.npy")
+        np.save(embeddings_path, embeddings)
+        for backend in ["chroma"] + args.numpy:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.retriever_backends", "--worker", backend,
+                 "--embeddings", embeddings_path, "--k", str(args.k), "--repeats", str(args.repeats)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            stats = json.loads(output.strip().splitlines()[-1])
+            if reference_ids is None:
+                reference_ids = stats["ids"]
+            # agreement with chroma's HNSW results, exact search may legitimately find better neighbours
+            overlap = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(stats["ids"], reference_ids)])
+            rows.append([backend, f"{stats['load_s']:.2f}", f"{stats['first_ms']:.1f}", f"{stats['p50_ms']:.2f}",
+                         f"{stats['p99_ms']:.2f}", f"{stats['max_rss_mb']:.0f}", f"{overlap:.3f}"])
+
+    print_table(["backend", "load_s", "first_ms", "p50_ms", "p99_ms", "max_rss_mb", f"overlap@{args.k}"], rows)
+
+
+if __name__ == "__main__":
+    main()
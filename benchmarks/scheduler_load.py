@@ -0,0 +1,94 @@
+"""
+Burst of concurrent chat calls through the LLM scheduler against the local Groq stub.
+
+Half of the calls are intermediate decisions and half final answers, so the report shows how
+priority admission orders them; calls that still fail after the retries are counted as failed.
+The bare client (no scheduler, no retries) runs the same burst for comparison.
+
+Run from the repository root, with a stub it starts itself:
+    python -m benchmarks.scheduler_load --calls 40 --rpm 20 --failure-rate 0.1
+or against a running stub / endpoint:
+    python -m benchmarks.scheduler_load --base-url http://127.0.0.1:8099
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import percentile, print_table
+from custom_agents.llm_scheduler import GroqScheduler, make_groq_llm, with_priority, PRIORITY_ANSWER, PRIORITY_DECISION
+
+
+def start_stub(port, rpm, failure_rate, latency):
+    import uvicorn
+    from benchmarks.groq_stub_server import create_app
+
+    server = uvicorn.Server(uvicorn.Config(create_app(rpm, failure_rate, latency), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def run_burst(llm, calls, threads):
+    def one(i):
+        priority = PRIORITY_ANSWER if i % 2 else PRIORITY_DECISION
+        start = time.perf_counter()
+        try:
+            with_priority(llm, priority).invoke(f"question {i}")
+            ok = True
+        except Exception as e:
+            print(f"#call {i} failed: {type(e).__name__}")
+            ok = False
+        return priority, ok, time.perf_counter() - start
+
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(one, range(calls)))
+
+
+def summarize(name, outcomes):
+    rows = []
+    for priority, label in [(PRIORITY_ANSWER, "answer"), (PRIORITY_DECISION, "decision")]:
+        latencies = [seconds for p, ok, seconds in outcomes if p == priority and ok]
+        failed = sum(1 for p, ok, _ in outcomes if p == priority and not ok)
+        rows.append([name, label, len(latencies), failed,
+                     f"{percentile(latencies, 50):.2f}", f"{percentile(latencies, 95):.2f}"])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="endpoint to load, a stub is started when missing")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--calls", type=int, default=40)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--rpm", type=int, default=20, help="limit of the started stub and of the scheduler")
+    parser.add_argument("--tpm", type=int, default=100000, help="tokens per minute of the scheduler")
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None:
+        start_stub(args.port, args.rpm, args.failure_rate, args.latency)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    bare = make_groq_llm("stub-key", base_url=base_url).llm
+    start = time.perf_counter()
+    rows = summarize("bare", run_burst(bare, args.calls, args.threads))
+    print(f"#bare burst {time.perf_counter() - start:.1f}s")
+
+    # let the stub window drain so both runs start with a full quota
+    if args.base_url is None:
+        time.sleep(60)
+    scheduler = GroqScheduler(requests_per_minute=args.rpm, tokens_per_minute=args.tpm, base_delay=0.5)
+    scheduled = make_groq_llm("stub-key", base_url=base_url, scheduler=scheduler)
+    start = time.perf_counter()
+    rows += summarize("scheduled", run_burst(scheduled, args.calls, args.threads))
+    print(f"#scheduled burst {time.perf_counter() - start:.1f}s {scheduler.stats()}")
+
+    print_table(["client", "priority", "ok", "failed", "p50 s", "p95 s"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from custom_agents.context_builder import estimate_tokens
+
+QUESTION_PATTERN = re.compile(r"Question(?: to analyze)?: (.*?)(?:\.  |\s*\n)")
+HISTORIC_PATTERN = re.compile(r"Query historic \(.*?\): (.*?)\n\s*Data Context:", re.DOTALL)
+
+
+def prompt_kind(prompt):
+    """
+    Which chain of the agents rendered the prompt, told apart by the choices each prompt lists
+    """
+    if "decompose the user question" in prompt:
+        return "plan"
+    if "'reject_question'" in prompt:
+        return "route"
+    if "'reanalize_doc'" in prompt and "Query historic" in prompt:
+        return "plan_step"
+    if "'reanalize_doc'" in prompt:
+        return "reflect"
+    if "'query_semantic_db'" in prompt:
+        return "analyze"
+    return "generate"
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic stand-in for ChatGroq, answers each prompt kind with canned JSON and never goes to the network.
+
+    Analyze always asks for a retrieval, with a query that changes with the query historic so every round
+    fetches new chunks; reflect always answers reflect_choice, which picks the path through the graph
+    (the private docs agent stops querying after two retrievals whatever the choice is). The fused
+    plan_step answers both: reflect_choice and the next query, or a first query when the context is empty.
+
+    Attributes:
+        reflect_choice: 'generate_answer', 'add_more_context' or 'reanalize_doc'
+        latency: seconds slept per call to simulate the model, 0 measures only the agent's own overhead
+        counts: calls per prompt kind
+        tokens: prompt and completion tokens over all calls
+    """
+    reflect_choice: str = "generate_answer"
+    latency: float = 0.0
+    model_name: str = "scripted"
+    counts: Counter = None
+    tokens: Counter = None
+    lock: object = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.counts = Counter()
+        self.tokens = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def respond(self, prompt):
+        kind = prompt_kind(prompt)
+        with self.lock:
+            self.counts[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        match = QUESTION_PATTERN.search(prompt)
+        question = match.group(1).strip() if match else ""
+        if kind == "plan":
+            return json.dumps([{"choice": "ask_private_docs_expert", "query": question}])
+        if kind == "route":
+            return json.dumps({"choice": "analize_doc"})
+        if kind == "reflect":
+            return json.dumps({"choice": self.reflect_choice, "justification": "scripted " + self.reflect_choice})
+        if kind in ("analyze", "plan_step"):
+            historic = HISTORIC_PATTERN.search(prompt)
+            round_number = len(historic.group(1).split("\n")) if historic and historic.group(1).strip() else 0
+            query = question if round_number == 0 else f"{question} (detail {round_number})"
+            if kind == "analyze":
+                return json.dumps({"choice": "query_semantic_db", "query": query})
+            choice = self.reflect_choice if "Reference number" in prompt else "add_more_context"
+            return json.dumps({"choice": choice, "query": "" if choice == "generate_answer" else query, "justification": "scripted " + choice})
+        return f"Scripted answer to: {question} (1)\n(1): file scripted"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        text = self.respond(prompt)
+        usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self._count_tokens(usage)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))],
+                          llm_output={"token_usage": usage, "model_name": self.model_name})
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        text = self.respond(prompt)
+        self._count_tokens({"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(text)})
+        for word in text.split(" "):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _count_tokens(self, usage):
+        with self.lock:
+            self.tokens["prompt_tokens"] += usage["prompt_tokens"]
+            self.tokens["completion_tokens"] += usage["completion_tokens"]
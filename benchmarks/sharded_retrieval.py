@@ -0,0 +1,82 @@
+"""
+Latency of one collection against the same chunks split into N shards searched concurrently.
+
+Shards are built from private_docs without re-embedding, whole books go to one shard (by file name hash).
+Query embeddings are computed once up front so the embedder counts in no configuration.
+
+Run from the repository root:
+    python -m benchmarks.sharded_retrieval --split 2 4 8
+    python -m benchmarks.sharded_retrieval --shards 2 4 8
+"""
+import argparse
+import time
+import zlib
+
+from benchmarks.common import load_queries, percentile, print_table
+from custom_agents.retrievers import ChromaRetriever, ShardedRetriever, import_chromadb
+
+SHARDS_PATH = "./docsdb2_cache/shards"
+
+
+def shard_names(n_shards):
+    return [f"private_docs_{i}_of_{n_shards}" for i in range(n_shards)]
+
+
+def split_collection(source, n_shards, persist_path=SHARDS_PATH):
+    client = import_chromadb().PersistentClient(path=persist_path)
+    shards = []
+    for name in shard_names(n_shards):
+        try:
+            client.delete_collection(name)
+        except ValueError:
+            pass
+        shards.append(client.create_collection(name, metadata={"hnsw:space": source.space}))
+    for batch in source.scan(include_embeddings=True):
+        rows = [[] for _ in range(n_shards)]
+        for j, meta in enumerate(batch["metadatas"]):
+            rows[zlib.crc32(meta["file_name"].encode("utf-8")) % n_shards].append(j)
+        for shard, selected in zip(shards, rows):
+            if selected:
+                shard.add(ids=[batch["ids"][j] for j in selected], embeddings=[list(batch["embeddings"][j]) for j in selected],
+                          metadatas=[batch["metadatas"][j] for j in selected], documents=[batch["documents"][j] for j in selected])
+    print(f"#split into {n_shards} shards: {[shard.count() for shard in shards]}")
+
+
+def run(name, retriever, query_embeddings, k, reference):
+    retriever.query(query_embeddings[:1], n_results=k)
+    latencies, overlaps = [], []
+    for i, embedding in enumerate(query_embeddings):
+        start = time.perf_counter()
+        result = retriever.query([embedding], n_results=k)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        overlaps.append(len(set(result["ids"]) & set(reference[i])) / max(len(reference[i]), 1))
+    return [name, retriever.count(), f"{percentile(latencies, 50):.2f}", f"{percentile(latencies, 99):.2f}",
+            f"{sum(overlaps) / len(overlaps):.3f}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--split", type=int, nargs="+", help="build shard sets of these sizes from private_docs")
+    parser.add_argument("--shards", type=int, nargs="+", help="shard set sizes to benchmark")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    source = ChromaRetriever("./docsdb2", "private_docs")
+    for n_shards in args.split or []:
+        split_collection(source, n_shards)
+    if not args.shards:
+        return
+
+    from custom_agents.embedder import load_embedding_function
+    query_embeddings = [list(map(float, e)) for e in load_embedding_function()([entry["query"] for entry in load_queries()])]
+    reference = [result["ids"] for result in source.query(query_embeddings, n_results=args.k)]
+
+    rows = [run("1 collection", source, query_embeddings, args.k, reference)]
+    for n_shards in args.shards:
+        sharded = ShardedRetriever([ChromaRetriever(SHARDS_PATH, name) for name in shard_names(n_shards)])
+        rows.append(run(f"{n_shards} shards", sharded, query_embeddings, args.k, reference))
+    print_table(["layout", "chunks", "p50_ms", "p99_ms", f"overlap@{args.k}"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Which step dominates: per node summary of the traces written by the agents.
+
+Run from the repository root:
+    python -m benchmarks.trace_report
+    python -m benchmarks.trace_report --path ./docsdb2_cache/traces.jsonl --agent private_docs
+"""
+import argparse
+import json
+from collections import defaultdict
+
+from benchmarks.common import percentile, print_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="./docsdb2_cache/traces.jsonl")
+    parser.add_argument("--agent", help="only runs of this agent ('private_docs' or 'multiquery')")
+    args = parser.parse_args()
+
+    spans = defaultdict(list)
+    runs = []
+    with open(args.path) as f:
+        for line in f:
+            record = json.loads(line)
+            if args.agent and record["agent"] != args.agent:
+                continue
+            if record["type"] == "run":
+                runs.append(record)
+            else:
+                spans[record["node"]].append(record)
+
+    total_ms = sum(run["total_ms"] for run in runs) or 1
+    rows = []
+    for node, records in sorted(spans.items(), key=lambda item: -sum(r["wall_ms"] for r in item[1])):
+        wall = [r["wall_ms"] for r in records]
+        decisions = defaultdict(int)
+        for r in records:
+            if "decision" in r:
+                decisions[r["decision"]] += 1
+        rows.append([node, len(records), f"{percentile(wall, 50):.1f}", f"{percentile(wall, 95):.1f}",
+                     f"{100 * sum(wall) / total_ms:.1f}",
+                     sum(r.get("prompt_tokens", 0) for r in records), sum(r.get("completion_tokens", 0) for r in records),
+                     " ".join(f"{d}:{n}" for d, n in sorted(decisions.items()))])
+    print(f"{len(runs)} runs, mean {total_ms / max(len(runs), 1):.1f} ms")
+    lookups = [run["answer_cache_hit"] for run in runs if "answer_cache_hit" in run]
+    if lookups:
+        print(f"answer cache: {sum(lookups)}/{len(lookups)} lookups hit")
+    coalesced = sum(1 for run in runs if run.get("coalesced"))
+    if coalesced:
+        print(f"single flight: {coalesced}/{len(runs)} runs served by an identical question in flight")
+    ttft = [run["time_to_first_token_ms"] for run in runs if "time_to_first_token_ms" in run]
+    if ttft:
+        print(f"time to first token: p50 {percentile(ttft, 50):.1f} ms, p95 {percentile(ttft, 95):.1f} ms over {len(ttft)} streamed runs")
+    drafts = [r["speculative"] for r in spans.get("reflect_on_answer", []) if "speculative" in r]
+    if drafts:
+        saved = [r["speculative_saved_ms"] for r in spans.get("generate_answer", []) if "speculative_saved_ms" in r]
+        print(f"speculative answers: {drafts.count('hit')}/{len(drafts)} used, {sum(saved):.0f} ms saved "
+              f"(mean {sum(saved) / max(len(saved), 1):.1f} ms per hit)")
+    print_table(["node", "count", "p50 ms", "p95 ms", "% of run time", "prompt tok", "completion tok", "decisions"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Cache of final answers matched by embedding similarity of the question.
+
+    Entries expire after ttl seconds, the least recently used entry is evicted past max_size
+    and the whole cache is dropped when the fingerprint of the document collection changes.
+
+    Attributes:
+        hits: number of lookups answered from the cache
+        misses: number of lookups that found no similar question
+    """
+    def __init__(self, threshold=0.95, ttl=3600, max_size=256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._fingerprint = None
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding, fingerprint):
+        """
+        Find the cached answer whose question is most similar to the given one
+
+        Args:
+            embedding (list): question embedding
+            fingerprint: current fingerprint of the document collection
+
+        Returns:
+            str: cached answer, or None when no entry is similar enough
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._expire()
+            best_key, best_similarity = None, self.threshold
+            for key, (entry_vector, _answer, _created) in self._entries.items():
+                similarity = float(np.dot(vector, entry_vector))
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][1]
+
+    def store(self, question, embedding, answer, fingerprint):
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._entries[question] = (self._normalize(embedding), answer, time.monotonic())
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _check_fingerprint(self, fingerprint):
+        if fingerprint != self._fingerprint:
+            self._entries.clear()
+            self._fingerprint = fingerprint
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        for key in [key for key, entry in self._entries.items() if entry[2] < deadline]:
+            del self._entries[key]
+
+    def _normalize(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
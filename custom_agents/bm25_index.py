@@ -0,0 +1,77 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+from custom_agents.pickled_index import PickledIndex
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse several ranked id lists, each id scores sum(1 / (k + rank)) over the lists it appears in
+
+    Returns:
+        list: ids, best fused score first
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+
+class BM25Index(PickledIndex):
+    """
+    Okapi BM25 inverted index over the chunks of a collection, the file name is indexed with the text
+    so author names and titles match exactly.
+    """
+    def __init__(self, ids, texts, k1=1.5, b=0.75, fingerprint=None):
+        self.ids = list(ids)
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = fingerprint
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+        for doc_index, text in enumerate(texts):
+            tokens = tokenize(text)
+            self.doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings[term].append((doc_index, frequency))
+        self.postings = dict(self.postings)
+        self.avg_length = sum(self.doc_lengths) / max(len(self.doc_lengths), 1)
+        num_docs = len(self.ids)
+        self.idf = {
+            term: math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    @classmethod
+    def from_retriever(cls, retriever, fingerprint=None):
+        ids, texts = [], []
+        for batch in retriever.scan():
+            for chunk_id, meta, doc in zip(batch["ids"], batch["metadatas"], batch["documents"]):
+                ids.append(chunk_id)
+                texts.append(f"{meta.get('file_name', '')} {doc}")
+        return cls(ids, texts, fingerprint=fingerprint)
+
+    def search(self, query, k=20):
+        """
+        Returns:
+            list: (id, score) tuples, best first
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for doc_index, frequency in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_index] / self.avg_length)
+                scores[doc_index] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        best = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return [(self.ids[doc_index], score) for doc_index, score in best]
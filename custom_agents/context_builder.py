@@ -0,0 +1,71 @@
+def estimate_tokens(text):
+    """
+    Rough Llama3 token count, about four characters per token for English prose
+    """
+    return len(text) // 4 + 1
+
+
+def results_to_chunks(results):
+    """
+    Convert one query's retrieval results into chunk records
+
+    Args:
+        results (dict): per query result with 'ids', 'metadatas', 'documents' and 'distances'
+
+    Returns:
+        list: dicts with 'id', 'file_name', 'page', 'document' and 'distance'
+    """
+    return [
+        {
+            "id": chunk_id,
+            "file_name": meta["file_name"],
+            "page": meta["page"],
+            "document": doc,
+            "distance": distance,
+        }
+        for chunk_id, meta, doc, distance in zip(results["ids"], results["metadatas"], results["documents"], results["distances"])
+    ]
+
+
+def merge_chunks(chunks, new_chunks):
+    """
+    Add new chunks to the ones already retrieved, a chunk seen twice keeps its best (lowest) distance
+
+    Returns:
+        list: merged chunks in first-seen order
+    """
+    merged = {chunk["id"]: chunk for chunk in chunks}
+    for chunk in new_chunks:
+        current = merged.get(chunk["id"])
+        if current is None or chunk["distance"] < current["distance"]:
+            merged[chunk["id"]] = chunk
+    return list(merged.values())
+
+
+def render_chunk(number, chunk):
+    return f"Reference number {number}: {chunk['file_name']}, Text page {chunk['page']}: {chunk['document']}\n"
+
+
+def render_context(chunks, token_budget):
+    """
+    Render chunks into the prompt context, dropping the lowest scoring ones that do not fit in the budget
+
+    Args:
+        chunks (list): chunk records
+        token_budget (int): maximum estimated tokens of the rendered context
+
+    Returns:
+        str: context with references numbered once across all retrieval rounds
+    """
+    report_final = ""
+    used_tokens = 0
+    number = 0
+    for chunk in sorted(chunks, key=lambda chunk: chunk["distance"]):
+        entry = render_chunk(number + 1, chunk)
+        entry_tokens = estimate_tokens(entry)
+        if used_tokens + entry_tokens > token_budget:
+            continue
+        number += 1
+        used_tokens += entry_tokens
+        report_final += entry
+    return report_final
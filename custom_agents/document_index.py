@@ -0,0 +1,75 @@
+from collections import defaultdict
+
+import numpy as np
+
+from custom_agents.pickled_index import PickledIndex
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def kmeans(vectors, k, iterations=10):
+    """
+    Spherical k-means with a deterministic start (chunks spread evenly through the file), returns at most k unit centroids
+    """
+    k = min(k, len(vectors))
+    centroids = vectors[np.linspace(0, len(vectors) - 1, k).astype(int)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        updated = np.stack([
+            vectors[assignment == j].mean(axis=0) if np.any(assignment == j) else centroids[j]
+            for j in range(k)
+        ])
+        updated = _normalize(updated)
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return centroids
+
+
+class DocumentIndex(PickledIndex):
+    """
+    A few centroid vectors per file_name built from the chunk embeddings of a collection, used to pick
+    the files a query is about before searching their chunks.
+    """
+    def __init__(self, file_names, centroids, owners, fingerprint=None, centroids_per_file=None):
+        self.file_names = list(file_names)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        # file index of every centroid row
+        self.owners = np.asarray(owners, dtype=np.int32)
+        self.fingerprint = fingerprint
+        # as requested, files with fewer chunks than this have fewer centroids
+        self.centroids_per_file = centroids_per_file
+
+    @classmethod
+    def from_retriever(cls, retriever, centroids_per_file=3, fingerprint=None):
+        by_file = defaultdict(list)
+        for batch in retriever.scan(include_embeddings=True):
+            for meta, embedding in zip(batch["metadatas"], batch["embeddings"]):
+                by_file[meta["file_name"]].append(embedding)
+
+        file_names, centroids, owners = [], [], []
+        for file_name, embeddings in by_file.items():
+            file_centroids = kmeans(_normalize(np.asarray(embeddings, dtype=np.float32)), centroids_per_file)
+            owners.extend([len(file_names)] * len(file_centroids))
+            centroids.append(file_centroids)
+            file_names.append(file_name)
+        return cls(file_names, np.concatenate(centroids) if centroids else np.zeros((0, 0)), owners, fingerprint, centroids_per_file)
+
+    def build_options(self):
+        return {"centroids_per_file": getattr(self, "centroids_per_file", None)}
+
+    def select(self, query_embeddings, n_files):
+        """
+        Returns:
+            list: per query, the n_files file names whose closest centroid has the highest cosine similarity, best first
+        """
+        similarities = _normalize(np.asarray(query_embeddings, dtype=np.float32)) @ self.centroids.T
+        selected = []
+        for row in similarities:
+            best = np.full(len(self.file_names), -np.inf, dtype=np.float32)
+            np.maximum.at(best, self.owners, row)
+            top = np.argsort(-best)[:n_files]
+            selected.append([self.file_names[i] for i in top])
+        return selected
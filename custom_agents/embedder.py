@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+
+from custom_agents.retrievers import import_chromadb
+
+MODEL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chroma", "onnx_models", "all-MiniLM-L6-v2", "onnx")
+
+
+class OnnxMiniLM:
+    """
+    all-MiniLM-L6-v2 ONNX embedder, same model files and pooling as chroma's DefaultEmbeddingFunction
+    but without importing chromadb, so backends that do not use chroma skip its import and the sqlite swap.
+    """
+    def __init__(self, model_dir=MODEL_DIR, max_length=256, batch_size=32):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=max_length)
+        self.model = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), providers=onnxruntime.get_available_providers()
+        )
+        self.batch_size = batch_size
+
+    def __call__(self, input):
+        all_embeddings = []
+        for i in range(0, len(input), self.batch_size):
+            encoded = [self.tokenizer.encode(text) for text in input[i:i + self.batch_size]]
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            last_hidden_state = self.model.run(None, {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids),
+            })[0]
+            # mean pooling over the real tokens, then unit length
+            mask = attention_mask[:, :, None].astype(last_hidden_state.dtype)
+            embeddings = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            norms[norms == 0] = 1e-12
+            all_embeddings.append((embeddings / norms).astype(np.float32))
+        return np.concatenate(all_embeddings).tolist()
+
+
+def load_embedding_function():
+    """
+    Local ONNX embedder when chroma already downloaded the model, otherwise chroma's default (which downloads it)
+    """
+    if os.path.exists(os.path.join(MODEL_DIR, "model.onnx")):
+        return OnnxMiniLM()
+    import_chromadb()
+    from chromadb.utils import embedding_functions
+    return embedding_functions.DefaultEmbeddingFunction()
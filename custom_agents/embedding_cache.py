@@ -0,0 +1,132 @@
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    """
+    Normalize a query so that trivially different spellings share a cache entry.
+
+    Args:
+        text (str): raw query text
+
+    Returns:
+        str: lower-cased query with collapsed whitespace
+    """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of query embeddings in front of an embedding function, with an
+    optional SQLite store on disk that survives restarts.
+
+    Attributes:
+        hits: number of queries served from memory or disk
+        misses: number of queries that had to be embedded
+    """
+    def __init__(self, embedding_function, max_size=1024, persist_path=None):
+        self.embedding_function = embedding_function
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if persist_path:
+            os.makedirs(os.path.dirname(os.path.abspath(persist_path)), exist_ok=True)
+            db = self._connection()
+            db.execute("CREATE TABLE IF NOT EXISTS embeddings (query TEXT PRIMARY KEY, vector BLOB)")
+            db.commit()
+
+    def embed(self, queries):
+        """
+        Embed a list of queries, calling the embedding function once for all misses.
+
+        Args:
+            queries (list): query strings
+
+        Returns:
+            list: one embedding (list of floats) per query, in input order
+        """
+        keys = [normalize_query(query) for query in queries]
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in found:
+                    continue
+                vector = self._lookup(key)
+                if vector is not None:
+                    found[key] = vector
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            vectors = self.embedding_function(missing)
+            with self._lock:
+                for key, vector in zip(missing, vectors):
+                    vector = np.asarray(vector, dtype=np.float32)
+                    found[key] = vector
+                    self._remember(key, vector)
+            self._persist([(key, found[key].tobytes()) for key in missing])
+
+        with self._lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        return [found[key].tolist() for key in keys]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _lookup(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if not self.persist_path:
+            return None
+        try:
+            row = self._connection().execute("SELECT vector FROM embeddings WHERE query = ?", (key,)).fetchone()
+        except sqlite3.OperationalError as e:
+            # the store is busy or unreadable, embedding the query again is only slower
+            print(f"#embedding cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, vector)
+        return vector
+
+    def _persist(self, rows):
+        # one transaction for all the misses of a call, a failed write leaves them cached in memory only
+        if not self.persist_path or not rows:
+            return
+        db = self._connection()
+        try:
+            db.executemany("INSERT OR REPLACE INTO embeddings (query, vector) VALUES (?, ?)", rows)
+            db.commit()
+        except sqlite3.OperationalError as e:
+            db.rollback()
+            print(f"#embedding cache write failed: {e}")
+
+    def _connection(self):
+        # one connection per thread, several API workers share the file so readers must not block the writer
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.persist_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _remember(self, key, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
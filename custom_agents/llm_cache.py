@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LLMResponseCache:
+    """
+    Persistent cache of parsed LLM outputs keyed by model name and a hash of the rendered prompt.
+
+    Backed by SQLite in WAL mode so several processes (streamlit, api workers) can share the file.
+    Rows older than max_age seconds are dropped and the oldest rows are trimmed past max_entries.
+    """
+    def __init__(self, path, max_entries=20000, max_age=7 * 24 * 3600, evict_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._connection()
+        db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, value TEXT, created_at REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        db.commit()
+
+    def key(self, model_name, prompt):
+        return hashlib.sha256(f"{model_name}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, model_name, prompt):
+        """
+        Returns:
+            tuple: (found, value) where value is the parsed output stored for this prompt
+        """
+        row = self._connection().execute(
+            "SELECT value FROM responses WHERE key = ? AND created_at >= ?",
+            (self.key(model_name, prompt), time.time() - self.max_age),
+        ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, json.loads(row[0])
+
+    def put(self, model_name, prompt, value):
+        db = self._connection()
+        db.execute(
+            "INSERT OR REPLACE INTO responses (key, model, value, created_at) VALUES (?, ?, ?, ?)",
+            (self.key(model_name, prompt), model_name, json.dumps(value), time.time()),
+        )
+        db.commit()
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        db = self._connection()
+        db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+        db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _connection(self):
+        # one connection per thread, sqlite connections must not be shared across threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+
+class CachedChain:
+    """
+    Drop-in replacement for `prompt | llm | parser` that looks the rendered prompt up in an LLMResponseCache first.
+
+    Only outputs holding every key of required_keys are stored (for a list output, every entry must), so a
+    malformed response fails once instead of being replayed from the cache.
+    """
+    def __init__(self, prompt, llm, parser, cache, bypass=False, required_keys=()):
+        self.prompt = prompt
+        self.cache = cache
+        self.bypass = bypass or cache is None
+        self.required_keys = tuple(required_keys)
+        self.model_name = getattr(llm, "model_name", None) or type(llm).__name__
+        self.chain = llm | parser
+
+    def invoke(self, inputs, config=None):
+        rendered = self.prompt.format(**inputs)
+        if not self.bypass:
+            found, value = self.cache.get(self.model_name, rendered)
+            if found:
+                return value
+
+        value = self.chain.invoke(rendered, config=config)
+        if not self.bypass and self.is_complete(value):
+            self.cache.put(self.model_name, rendered, value)
+        return value
+
+    def is_complete(self, value):
+        entries = value if isinstance(value, list) else [value]
+        return all(isinstance(entry, dict) and all(key in entry for key in self.required_keys) for entry in entries)
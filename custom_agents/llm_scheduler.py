@@ -0,0 +1,281 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from langchain_core.runnables import Runnable
+
+from custom_agents.context_builder import estimate_tokens
+
+# lower runs first, the final answer the user is waiting for goes ahead of intermediate decisions
+PRIORITY_ANSWER = 0
+PRIORITY_DECISION = 1
+# speculative drafts may be thrown away, they only get the capacity decisions leave free
+PRIORITY_SPECULATIVE = 2
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Refills continuously at per_minute / 60 units per second up to capacity. Not thread safe, used under the scheduler lock.
+    """
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def drain(self):
+        self._refill()
+        self.level = min(self.level, 0.0)
+
+
+def is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # connection errors and timeouts of the groq / httpx clients carry no status
+    return type(error).__name__ in {"APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout", "RemoteProtocolError"}
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class GroqScheduler:
+    """
+    Admission control in front of the Groq API shared by every chain of the process.
+
+    A call is admitted when it is the highest priority waiter, a concurrency slot is free and the
+    requests-per-minute and tokens-per-minute buckets can pay for it. Retryable failures (429, 5xx,
+    connection errors) are retried with jittered exponential backoff, honouring retry-after.
+
+    The tokens bucket is charged an estimate on admission, a call given count_tokens is settled
+    against the tokens it actually used once it finishes.
+    """
+    def __init__(self, requests_per_minute=30, tokens_per_minute=6000, max_concurrent=4,
+                 max_retries=5, base_delay=1.0, max_delay=30.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.queued_seconds = 0.0
+        self._active = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def admit(self, priority, estimated_tokens):
+        ticket = (priority, next(self._sequence))
+        start = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            self._cond.notify_all()
+            while True:
+                if self._waiting[0] == ticket and self._active < self.max_concurrent:
+                    wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                    if wait <= 0:
+                        break
+                    self._cond.wait(timeout=wait)
+                else:
+                    self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.requests.take(1)
+            self.tokens.take(estimated_tokens)
+            self._active += 1
+            self.calls += 1
+            self.queued_seconds += time.monotonic() - start
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def call(self, fn, priority=PRIORITY_DECISION, estimated_tokens=0, count_tokens=None):
+        attempt = 0
+        while True:
+            with self.admit(priority, estimated_tokens):
+                try:
+                    result = fn()
+                except Exception as e:
+                    if attempt >= self.max_retries or not is_retryable(e):
+                        self.failures += 1
+                        raise
+                    delay = self._backoff(e, attempt)
+                else:
+                    if count_tokens is not None:
+                        self.settle(estimated_tokens, count_tokens(result))
+                    return result
+            self._sleep_before_retry(delay)
+            attempt += 1
+
+    def stream(self, fn, priority=PRIORITY_DECISION, estimated_tokens=0, count_tokens=None):
+        """
+        Like call for a function returning an iterator, the slot is held while streaming and
+        only failures before the first chunk are retried; count_tokens gets the list of chunks
+        """
+        attempt = 0
+        while True:
+            with self.admit(priority, estimated_tokens):
+                started = False
+                chunks = []
+                try:
+                    for chunk in fn():
+                        started = True
+                        chunks.append(chunk)
+                        yield chunk
+                    if count_tokens is not None:
+                        self.settle(estimated_tokens, count_tokens(chunks))
+                    return
+                except Exception as e:
+                    if started or attempt >= self.max_retries or not is_retryable(e):
+                        self.failures += 1
+                        raise
+                    delay = self._backoff(e, attempt)
+            self._sleep_before_retry(delay)
+            attempt += 1
+
+    def settle(self, estimated_tokens, used_tokens):
+        """
+        Give back what the admission estimate overcharged, or charge what it missed
+        """
+        with self._cond:
+            self.tokens.refund(min(estimated_tokens, self.tokens.capacity) - used_tokens)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"calls": self.calls, "retries": self.retries, "failures": self.failures,
+                    "queued_seconds": round(self.queued_seconds, 3), "waiting": len(self._waiting)}
+
+    def _backoff(self, error, attempt):
+        if getattr(error, "status_code", None) == 429:
+            # the server says we are over the limit, stop admitting anyone until the buckets refill
+            with self._cond:
+                self.requests.drain()
+                self.tokens.drain()
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+        print(f"#scheduler retry {attempt + 1} in {delay:.2f}s after {type(error).__name__}")
+        return delay
+
+    def _sleep_before_retry(self, delay):
+        with self._cond:
+            self.retries += 1
+        time.sleep(delay)
+
+
+class ScheduledChatModel(Runnable):
+    """
+    Chat model wrapper whose invoke and stream go through a GroqScheduler, usable in `prompt | llm | parser` chains.
+    """
+    def __init__(self, llm, scheduler, priority=PRIORITY_DECISION, completion_tokens=512):
+        self.llm = llm
+        self.scheduler = scheduler
+        self.priority = priority
+        self.completion_tokens = completion_tokens
+        self.model_name = getattr(llm, "model_name", None) or type(llm).__name__
+
+    def with_priority(self, priority):
+        return ScheduledChatModel(self.llm, self.scheduler, priority, self.completion_tokens)
+
+    def invoke(self, input, config=None, **kwargs):
+        prompt_tokens = self._prompt_tokens(input)
+        return self.scheduler.call(lambda: self.llm.invoke(input, config, **kwargs), self.priority,
+                                   prompt_tokens + self.completion_tokens,
+                                   lambda message: self._used_tokens(prompt_tokens, [message]))
+
+    def stream(self, input, config=None, **kwargs):
+        prompt_tokens = self._prompt_tokens(input)
+        yield from self.scheduler.stream(lambda: self.llm.stream(input, config, **kwargs), self.priority,
+                                         prompt_tokens + self.completion_tokens,
+                                         lambda chunks: self._used_tokens(prompt_tokens, chunks))
+
+    @staticmethod
+    def _prompt_tokens(input):
+        text = input.to_string() if hasattr(input, "to_string") else str(input)
+        return estimate_tokens(text)
+
+    @staticmethod
+    def _used_tokens(prompt_tokens, messages):
+        # the usage the API reports when the client exposes it on the message, else the same estimate as the prompt
+        for message in messages:
+            usage = getattr(message, "usage_metadata", None)
+            if usage and usage.get("total_tokens"):
+                return usage["total_tokens"]
+        return prompt_tokens + estimate_tokens("".join(str(message.content) for message in messages))
+
+
+def with_priority(llm, priority):
+    """
+    The llm with the given scheduling priority, or unchanged when it is not a ScheduledChatModel
+    """
+    return llm.with_priority(priority) if isinstance(llm, ScheduledChatModel) else llm
+
+
+def scheduler_from_env():
+    """
+    GroqScheduler with the account limits of GROQ_REQUESTS_PER_MINUTE / GROQ_TOKENS_PER_MINUTE (default 30 / 6000)
+    """
+    return GroqScheduler(
+        requests_per_minute=int(os.environ.get("GROQ_REQUESTS_PER_MINUTE", "30")),
+        tokens_per_minute=int(os.environ.get("GROQ_TOKENS_PER_MINUTE", "6000")),
+    )
+
+
+def make_groq_llm(api_key, model_name="llama3-70b-8192", scheduler=None, base_url=None, max_connections=20, timeout=60):
+    """
+    ChatGroq on a pooled HTTP client with its own retries disabled, behind a GroqScheduler
+    (by default one with the limits of scheduler_from_env)
+    """
+    import httpx
+    from langchain_groq import ChatGroq
+
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    llm = ChatGroq(
+        temperature=0,
+        groq_api_key=api_key,
+        model_name=model_name,
+        base_url=base_url,
+        max_retries=0,
+        http_client=httpx.Client(limits=limits, timeout=timeout),
+        http_async_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+    )
+    return ScheduledChatModel(llm, scheduler or scheduler_from_env())
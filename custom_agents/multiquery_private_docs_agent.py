@@ -3,6 +3,12 @@ from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langgraph.graph import END, StateGraph
 from custom_agents.prompt_formatter import PromptFormatter
+from custom_agents.llm_cache import LLMResponseCache, CachedChain
+from custom_agents.single_flight import SingleFlight
+from custom_agents.llm_scheduler import with_priority, PRIORITY_ANSWER, PRIORITY_DECISION
+from custom_agents.tracing import Tracer, traced_node, traced_route, llm_config
+from custom_agents.embedding_cache import normalize_query
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 from custom_agents.private_docs_agent import private_docs_agent
@@ -15,6 +21,7 @@ class GraphState(TypedDict):
         question: user question
         generation: LLM generation
         context: results from semantic db so far
+        trace: RunTrace collecting per node timings, tokens and routing decisions
     """
     question : str
     generation : str
@@ -24,23 +31,34 @@ class GraphState(TypedDict):
     query: str
     generation_log: str
     query_plan: str
+    trace: object
 
 class multiquery_private_docs_agent:
-    def __init__(self,llm):
+    def __init__(self,llm,private_docs_expert=None,max_workers=4,
+                 llm_cache_path="./docsdb2_cache/llm_responses.sqlite",llm_cache_bypass=(),
+                 trace_path="./docsdb2_cache/traces.jsonl"):
         self.llm = llm
+        # temperature 0 decision chains ('generate_query_plan', 'check_finance_question') reuse earlier outputs for an identical prompt
+        self.llm_cache = LLMResponseCache(llm_cache_path) if llm_cache_path else None
+        self.llm_cache_bypass = set(llm_cache_bypass)
+        # built once and shared by every plan entry, reopening the db and recompiling the graph per request is expensive
+        self.private_docs_expert = private_docs_expert or private_docs_agent(llm)
+        self.max_workers = max_workers
+        self.single_flight = SingleFlight()
+        self.tracer = Tracer(trace_path)
         self.generate_answer_chain = self._initialize_generate_answer_chain()
         self.generate_query_plan_chain = self._initialize_generate_query_plan_chain()
         self.check_finance_question_chain = self._initialize_check_finance_question_chain()
 
         self.workflow = StateGraph(GraphState)
-        self.workflow.add_node("reject_question", self.reject_question)
-        self.workflow.add_node("generate_answer", self.generate_answer)
-        self.workflow.add_node("init_agent", self.init_agent)
-        self.workflow.add_node("generate_query_plan",self.generate_query_plan)
-        self.workflow.add_node("execute_query_plan",self.execute_query_plan)
+        self.workflow.add_node("reject_question", traced_node("reject_question", self.reject_question))
+        self.workflow.add_node("generate_answer", traced_node("generate_answer", self.generate_answer))
+        self.workflow.add_node("init_agent", traced_node("init_agent", self.init_agent))
+        self.workflow.add_node("generate_query_plan",traced_node("generate_query_plan", self.generate_query_plan))
+        self.workflow.add_node("execute_query_plan",traced_node("execute_query_plan", self.execute_query_plan))
         
         self.workflow.set_conditional_entry_point(
-            self.check_finance_question,
+            traced_route("check_finance_question", self.check_finance_question),
             {
                 "analize_doc": "init_agent",
                 "reject_question": "reject_question",
@@ -88,7 +106,7 @@ class multiquery_private_docs_agent:
             template=generate_answer_formatter.prompt,
             input_variables=["question", "context"],
         )
-        return generate_answer_prompt | self.llm | StrOutputParser()
+        return generate_answer_prompt | with_priority(self.llm, PRIORITY_ANSWER) | StrOutputParser()
 
     def _initialize_generate_query_plan_chain(self):
         generate_query_plan_formatter = PromptFormatter("Llama3")
@@ -116,7 +134,7 @@ class multiquery_private_docs_agent:
             input_variables=["question"],
         )
 
-        return generate_query_plan_prompt | self.llm | JsonOutputParser()
+        return CachedChain(generate_query_plan_prompt, with_priority(self.llm, PRIORITY_DECISION), JsonOutputParser(), self.llm_cache, bypass="generate_query_plan" in self.llm_cache_bypass, required_keys=("choice", "query"))
 
     def _initialize_check_finance_question_chain(self):
         check_finance_question_formatter = PromptFormatter("Llama3")
@@ -138,7 +156,7 @@ class multiquery_private_docs_agent:
             input_variables=["question"],
         )
 
-        return check_finance_question_prompt | self.llm | JsonOutputParser()
+        return CachedChain(check_finance_question_prompt, with_priority(self.llm, PRIORITY_DECISION), JsonOutputParser(), self.llm_cache, bypass="check_finance_question" in self.llm_cache_bypass, required_keys=("choice",))
 
     def check_finance_question(self,state):
         """
@@ -156,7 +174,7 @@ class multiquery_private_docs_agent:
         question = state['question']
 
 
-        output = self.check_finance_question_chain.invoke({"question": question})
+        output = self.check_finance_question_chain.invoke({"question": question}, config=llm_config())
 
         print("Step: Routing to ", output['choice'])
 
@@ -181,7 +199,7 @@ class multiquery_private_docs_agent:
 
         
         # Answer Generation
-        generation = self.generate_answer_chain.invoke({"context": context, "question": question})
+        generation = self.generate_answer_chain.invoke({"context": context, "question": question}, config=llm_config())
         return {"generation": generation}
 
 
@@ -196,37 +214,45 @@ class multiquery_private_docs_agent:
         
         generation_log += info
 
-        output = self.generate_query_plan_chain.invoke({"question":question})
+        output = self.generate_query_plan_chain.invoke({"question":question}, config=llm_config())
 
-        return {"query_plan":output}
+        return {"query_plan":output,"generation_log":generation_log}
 
 
 
     def execute_query_plan(self,state):
 
-        private_docs_expert = private_docs_agent(self.llm)
+        private_docs_expert = self.private_docs_expert
 
         query_plan = state["query_plan"]
         generation_log = state["generation_log"]
         
         info = f"Step: executing plan\n"
         generation_log += info
-        final_output = ""
 
-        for entry in query_plan:
+        # every expert question is known up front, retrieve the first round for all of them at once
+        expert_questions = [entry['query'] for entry in query_plan if entry['choice'] == 'ask_private_docs_expert']
+        prefetched = dict(zip(expert_questions, private_docs_expert.retrieve_batch(expert_questions)))
+        # expert runs are traced on their own, linked to this run
+        parent_run_id = state["trace"].run_id if state.get("trace") else None
+
+        def run_entry(entry):
             choice = entry['choice']
             question = entry['query']
 
             if choice == 'ask_private_docs_expert':
-                output = private_docs_expert.ask_question({"question":question})
-            else: 
-                output = ""
+                return private_docs_expert.ask_question({"question":question,"prefetched_results":prefetched[question],"parent_run_id":parent_run_id})
+            return ""
+
+        # entries are independent, run them concurrently; map keeps the outputs in plan order
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(query_plan)))) as executor:
+            outputs = list(executor.map(run_entry, query_plan))
 
-            final_output += output + "\n"
+        final_output = "".join(output + "\n" for output in outputs)
         
         print("#44 ", query_plan)
         
-        return {"generation": final_output}
+        return {"generation": final_output,"generation_log":generation_log}
     
 
 
@@ -260,7 +286,20 @@ class multiquery_private_docs_agent:
 
 
     def ask_question(self, par_state):
-        answer = self.local_agent.invoke(par_state)['generation']
+        trace = self.tracer.start("multiquery", par_state["question"])
+        # identical questions arriving while one is being answered share its run
+        ran = []
+
+        def run():
+            ran.append(True)
+            return self.local_agent.invoke({**par_state, "trace": trace})['generation']
+
+        try:
+            answer = self.single_flight.do(normalize_query(par_state["question"]), run)
+        except Exception as e:
+            trace.finish(error=repr(e), coalesced=not ran)
+            raise
+        trace.finish(coalesced=not ran)
         return answer        
 
 
@@ -0,0 +1,35 @@
+import os
+import pickle
+
+
+class PickledIndex:
+    """
+    Persistence shared by the indexes built from every chunk of a retriever (BM25, document centroids).
+
+    A subclass provides from_retriever(retriever, fingerprint=None, **options), keeps the collection
+    fingerprint it was built from in self.fingerprint and returns the options it was built with from
+    build_options, so a persisted index is only reused for the same collection and the same options.
+    """
+    @classmethod
+    def load_or_build(cls, retriever, path, fingerprint, **options):
+        """
+        Load the index persisted at path, rebuilding it from the retriever's chunks when missing or stale
+        """
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                index = pickle.load(f)
+            if index.fingerprint == fingerprint and index.build_options() == options:
+                return index
+        index = cls.from_retriever(retriever, fingerprint=fingerprint, **options)
+        if path:
+            index.save(path)
+        return index
+
+    def build_options(self):
+        return {}
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
@@ -3,15 +3,28 @@ from typing_extensions import TypedDict
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langgraph.graph import END, StateGraph
-import sys
-
-__import__('pysqlite3')
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
-import chromadb
+import queue
+import threading
+import time
 
 import os
-from langchain_groq import ChatGroq
+from collections import defaultdict
 from custom_agents.prompt_formatter import PromptFormatter
+from custom_agents.embedding_cache import EmbeddingCache, normalize_query
+from custom_agents.answer_cache import AnswerCache
+from custom_agents.llm_cache import LLMResponseCache, CachedChain
+from custom_agents.context_builder import results_to_chunks, merge_chunks, render_context
+from custom_agents.reranking import mmr_select, cap_per_file
+from custom_agents.bm25_index import BM25Index, reciprocal_rank_fusion
+from custom_agents.document_index import DocumentIndex
+from custom_agents.retrievers import ChromaRetriever, ShardedRetriever
+from custom_agents.embedder import load_embedding_function
+from custom_agents.startup_timer import optional_phase
+from custom_agents.single_flight import SingleFlight
+from custom_agents.llm_scheduler import with_priority, PRIORITY_ANSWER, PRIORITY_DECISION, PRIORITY_SPECULATIVE
+from custom_agents.tracing import Tracer, traced_node, traced_route, llm_config, record
+from custom_agents.speculation import SpeculativeDraft
+import numpy as np
 
 
 class GraphState(TypedDict):
@@ -21,11 +34,15 @@ class GraphState(TypedDict):
     Attributes:
         question: user question
         generation: LLM generation
-        context: results from semantic db so far
+        chunks: deduplicated chunks retrieved from the semantic db so far, rendered into the prompt context on demand
+        prefetched_results: retrieval already done for the question by the caller, used as first round
+        token_queue: when present the final answer is streamed token by token into this queue
+        trace: RunTrace collecting per node timings, tokens and routing decisions
+        draft: SpeculativeDraft of the answer started alongside reflect (or plan_next_step), set only when it chose generate_answer
     """
     question : str
     generation : str
-    context : str
+    chunks : list
     num_queries: int 
     num_revisions: int
     analysis_choice: str
@@ -34,46 +51,122 @@ class GraphState(TypedDict):
     query_historic: str
     next_action: str
     observations: str
+    prefetched_results: dict
+    token_queue: object
+    trace: object
+    draft: object
 
 # In[6]:
 class private_docs_agent:
-    def __init__(self,llm):
+    def __init__(self,llm,embedding_cache_size=1024,embedding_cache_path="./docsdb2_cache/embeddings.sqlite",
+                 answer_cache_threshold=0.95,answer_cache_ttl=3600,answer_cache_size=256,
+                 llm_cache_path="./docsdb2_cache/llm_responses.sqlite",llm_cache_bypass=(),
+                 context_token_budget=4000,
+                 rerank=None,rerank_fetch_k=20,mmr_lambda=0.5,max_chunks_per_file=2,
+                 hybrid=False,bm25_path="./docsdb2_cache/bm25.pkl",
+                 top_files=None,centroids_per_file=3,document_index_path="./docsdb2_cache/document_index.pkl",
+                 speculative_retrieval=False,
+                 speculative_generation=False,topology="default",
+                 retriever=None,collections=None,trace_path="./docsdb2_cache/traces.jsonl",startup_timer=None):
         self.llm = llm
-        self.chroma_client = chromadb.PersistentClient(path="./docsdb2")
-        collections = self.chroma_client.list_collections()
-        for collection in collections:
-            print("#1 ", type(collection), collection.name)
-        self.collection = self.chroma_client.get_collection("private_docs")
-
-        self.generate_answer_chain = self._initialize_generate_answer_chain()
-        self.analyze_doc_chain = self._initialize_analyze_doc_chain()
-        self.reflect_chain = self._initialize_reflect_chain()
+        # llama3-70b-8192 window minus room for the prompts and the answer
+        self.context_token_budget = context_token_budget
+        # 'mmr' or 'file_cap' over-fetch rerank_fetch_k candidates so near duplicate books do not take every slot
+        self.rerank = rerank
+        self.rerank_fetch_k = rerank_fetch_k
+        self.mmr_lambda = mmr_lambda
+        self.max_chunks_per_file = max_chunks_per_file
+        self.hybrid = hybrid
+        # retrieve on the raw question in init_agent, the first LLM call then judges real chunks instead of an empty context
+        self.speculative_retrieval = speculative_retrieval
+        # draft the answer while reflect decides if the context is enough, kept when it is and cancelled otherwise
+        self.speculative_generation = speculative_generation
+        # 'default': reflect then analyze, two LLM calls per retrieval round; 'fused': one plan_next_step call decides and writes the next query
+        if topology not in ("default", "fused"):
+            raise ValueError(f"unknown topology {topology!r}, expected 'default' or 'fused'")
+        self.topology = topology
+        self.max_queries = 2
+        # chroma by default, or e.g. a NumpyRetriever exported from the collection, or
+        # collections=[(persist_path, collection_name), ...] searched concurrently as shards of one library
+        with optional_phase(startup_timer, "open retriever"):
+            if retriever is None and collections and len(collections) > 1:
+                retriever = ShardedRetriever([ChromaRetriever(persist_path, name) for persist_path, name in collections])
+            elif retriever is None and collections:
+                retriever = ChromaRetriever(*collections[0])
+            self.retriever = retriever or ChromaRetriever("./docsdb2", "private_docs")
+
+        # same ONNX MiniLM model the collection was built with, queried by embedding so repeats skip the embedder
+        with optional_phase(startup_timer, "load embedder"):
+            self.embedding_cache = EmbeddingCache(
+                load_embedding_function(),
+                max_size=embedding_cache_size,
+                persist_path=embedding_cache_path,
+            )
+        # answers of questions similar enough to a previous one, None threshold disables it
+        self.answer_cache = None
+        if answer_cache_threshold is not None:
+            self.answer_cache = AnswerCache(threshold=answer_cache_threshold, ttl=answer_cache_ttl, max_size=answer_cache_size)
+        # identical questions arriving while one is being answered wait for that run instead of starting their own
+        self.single_flight = SingleFlight()
+
+        # lexical index fused with the vector hits, exact terms like 'RSI' or author names are blurred by the embeddings
+        self.bm25_index = None
+        if hybrid:
+            with optional_phase(startup_timer, "load bm25 index"):
+                self.bm25_index = BM25Index.load_or_build(self.retriever, bm25_path, self.collection_fingerprint())
+
+        # two-stage retrieval: pick the top_files books by their centroids, then search only their chunks; None searches everything
+        self.top_files = top_files
+        self.document_index = None
+        if top_files:
+            with optional_phase(startup_timer, "load document index"):
+                self.document_index = DocumentIndex.load_or_build(self.retriever, document_index_path, self.collection_fingerprint(), centroids_per_file=centroids_per_file)
+
+        # temperature 0 decision chains ('analyze_doc', 'reflect', 'plan_step') reuse earlier outputs for an identical prompt
+        self.llm_cache = LLMResponseCache(llm_cache_path) if llm_cache_path else None
+        self.llm_cache_bypass = set(llm_cache_bypass)
+        # per node wall time, tokens, retrieval figures and routing decisions of every run, None keeps them in memory only
+        self.tracer = Tracer(trace_path)
+
+        with optional_phase(startup_timer, "build chains"):
+            self.generate_answer_chain = self._initialize_generate_answer_chain()
+            # same prompt, queued behind the decisions so a draft that may be discarded never delays them
+            self.draft_answer_chain = self._initialize_generate_answer_chain(PRIORITY_SPECULATIVE)
+            self.analyze_doc_chain = self._initialize_analyze_doc_chain()
+            self.reflect_chain = self._initialize_reflect_chain()
+            self.plan_step_chain = self._initialize_plan_step_chain()
 
         self.workflow = StateGraph(GraphState)
-        self.workflow.add_node("generate_answer", self.generate_answer)
-        self.workflow.add_node("query_semantic_db", self.query_semantic_db)
-        self.workflow.add_node("analyze_doc", self.analyze_doc)
-        self.workflow.add_node("init_agent", self.init_agent)
-        self.workflow.add_node("reanalize_doc", self.reanalize_doc)
-        self.workflow.add_node("add_more_context", self.add_more_context)
-        self.workflow.add_node("reflect_on_answer", self.reflect_on_answer)
+        self.workflow.add_node("generate_answer", traced_node("generate_answer", self.generate_answer))
+        self.workflow.add_node("query_semantic_db", traced_node("query_semantic_db", self.query_semantic_db))
+        self.workflow.add_node("init_agent", traced_node("init_agent", self.init_agent))
         #workflow.add_node("can_query",can_query)
         
         self.workflow.set_entry_point("init_agent")
         
         self.workflow.add_edge("generate_answer", END)
-        self.workflow.add_edge("init_agent","analyze_doc")
-        self.workflow.add_edge("query_semantic_db","reflect_on_answer")
-        #workflow.add_edge("analyze_doc", "can_query")
-        self.workflow.add_edge("add_more_context","analyze_doc")
-        self.workflow.add_edge("reanalize_doc","analyze_doc")
-        self.workflow.add_conditional_edges("reflect_on_answer",self.check_retrieval)
-        self.workflow.add_conditional_edges("analyze_doc",self.can_query)
+        self.workflow.add_conditional_edges("init_agent",traced_route("after_init", self.after_init))
+        if topology == "fused":
+            self.workflow.add_node("plan_next_step", traced_node("plan_next_step", self.plan_next_step))
+            self.workflow.add_conditional_edges("plan_next_step",traced_route("check_plan", self.check_plan))
+            self.workflow.add_conditional_edges("query_semantic_db",traced_route("after_query", self.after_query))
+        else:
+            self.workflow.add_node("analyze_doc", traced_node("analyze_doc", self.analyze_doc))
+            self.workflow.add_node("reanalize_doc", traced_node("reanalize_doc", self.reanalize_doc))
+            self.workflow.add_node("add_more_context", traced_node("add_more_context", self.add_more_context))
+            self.workflow.add_node("reflect_on_answer", traced_node("reflect_on_answer", self.reflect_on_answer))
+            self.workflow.add_edge("query_semantic_db","reflect_on_answer")
+            #workflow.add_edge("analyze_doc", "can_query")
+            self.workflow.add_edge("add_more_context","analyze_doc")
+            self.workflow.add_edge("reanalize_doc","analyze_doc")
+            self.workflow.add_conditional_edges("reflect_on_answer",traced_route("check_retrieval", self.check_retrieval))
+            self.workflow.add_conditional_edges("analyze_doc",traced_route("can_query", self.can_query))
         
         
-        self.local_agent = self.workflow.compile()
+        with optional_phase(startup_timer, "compile graph"):
+            self.local_agent = self.workflow.compile()
             
-    def _initialize_generate_answer_chain(self):
+    def _initialize_generate_answer_chain(self, priority=PRIORITY_ANSWER):
         generate_answer_formatter = PromptFormatter("Llama3")
         generate_answer_formatter.init_message("")
         generate_answer_formatter.add_message("""You are an AI assistant for finance and Investment Questions Tasks. 
@@ -100,7 +193,7 @@ class private_docs_agent:
             input_variables=["question", "context"],
         )
 
-        return generate_answer_prompt | self.llm | StrOutputParser()
+        return generate_answer_prompt | with_priority(self.llm, priority) | StrOutputParser()
 
     def _initialize_analyze_doc_chain(self):
         analyze_doc_formatter = PromptFormatter("Llama3")
@@ -130,7 +223,7 @@ class private_docs_agent:
             input_variables=["question","context","query_historic","observations"],
         )
         
-        return analyze_doc_prompt | self.llm | JsonOutputParser()
+        return CachedChain(analyze_doc_prompt, with_priority(self.llm, PRIORITY_DECISION), JsonOutputParser(), self.llm_cache, bypass="analyze_doc" in self.llm_cache_bypass, required_keys=("choice", "query"))
 
     def _initialize_reflect_chain(self):
         reflect_formatter = PromptFormatter("Llama3")
@@ -154,7 +247,36 @@ class private_docs_agent:
             input_variables=["question","context"],
         )
 
-        return reflect_prompt | self.llm | JsonOutputParser()
+        return CachedChain(reflect_prompt, with_priority(self.llm, PRIORITY_DECISION), JsonOutputParser(), self.llm_cache, bypass="reflect" in self.llm_cache_bypass, required_keys=("choice", "justification"))
+
+    def _initialize_plan_step_chain(self):
+        plan_step_formatter = PromptFormatter("Llama3")
+        plan_step_formatter.init_message("")
+        plan_step_formatter.add_message("""You are an expert in finance and investments.
+            You have received a question about the finance or investment fields, information in context and query historic.
+            
+            You must determine if the context data is enough to answer the question and, if it is not, which query to ask next to a semantic db
+            (the vectorstore contains all the internal notes and documents of the company to answer that question). The choices are:
+            
+            'generate_answer' (if consider there is enough information to elaborate the answer, another agent will complete the task)
+            'add_more_context' (if you consider the information in context is correct but it is incomplete and it needs more context)
+            'reanalize_doc' (choose this option if you think the context information is not relevant to answer the user question and it must be retrieved again)
+            If the context is empty never choose 'generate_answer'.
+            Return the JSON with a key 'choice' with no premable or explanation, a key 'query' with the next natural language query needed to search the db
+            (leave it blank for 'generate_answer') and a key 'justification' with your explanation about what is missing.
+            Ask only one topic per query, and do not repeat the queries present in the query historic.
+            
+            Question to analyze: {question}.  {observations}
+            Query historic (do not repeat the following queries since you have already asked, try another one): {query_historic}
+            Data Context: {context} 
+        """, "system")
+        plan_step_formatter.close_message("assistant")
+        plan_step_prompt = PromptTemplate(
+            template=plan_step_formatter.prompt,
+            input_variables=["question","context","query_historic","observations"],
+        )
+
+        return CachedChain(plan_step_prompt, with_priority(self.llm, PRIORITY_DECISION), JsonOutputParser(), self.llm_cache, bypass="plan_step" in self.llm_cache_bypass, required_keys=("choice",))
 
     def check_finance_question(self,state):
         """
@@ -192,12 +314,12 @@ class private_docs_agent:
         """
         print("Step: Analizing doc")
         question = state["question"]
-        context = state["context"]
+        context = self.render_context(state)
         observations = state["observations"]
 
         query_historic = state["query_historic"]
         #print("invoke anlize doc choice", question, context, query_historic,observations)
-        analyze_doc_choice = self.analyze_doc_chain.invoke({"question": question,"context": context,"query_historic":query_historic,"observations":observations})
+        analyze_doc_choice = self.analyze_doc_chain.invoke({"question": question,"context": context,"query_historic":query_historic,"observations":observations}, config=llm_config())
         print("Analysis choice: ", analyze_doc_choice)
         ### IF analyze_doc_choice
         return {"analysis_choice": analyze_doc_choice["choice"],"query":analyze_doc_choice["query"] }
@@ -219,11 +341,29 @@ class private_docs_agent:
         
         print("Step: Generating Final Response")
         question = state["question"]
-        context = state["context"]
+        context = self.render_context(state)
         
         # Answer Generation
         print("#7 ", context)
-        generation = self.generate_answer_chain.invoke({"context": context, "question": question})
+        token_queue = state.get("token_queue")
+        draft = state.get("draft")
+        if draft is not None:
+            # reflect accepted the context the draft was started on
+            record(speculative_saved_ms=draft.head_start_ms())
+            tokens = draft.tokens()
+        elif token_queue is None:
+            generation = self.generate_answer_chain.invoke({"context": context, "question": question}, config=llm_config())
+            return {"generation": generation}
+        else:
+            tokens = self.generate_answer_chain.stream({"context": context, "question": question}, config=llm_config())
+
+        generation = ""
+        for token in tokens:
+            if token_queue is not None:
+                if not generation and state.get("trace") is not None:
+                    state["trace"].set(time_to_first_token_ms=state["trace"].elapsed_ms())
+                token_queue.put(token)
+            generation += token
         return {"generation": generation}
 
 
@@ -242,52 +382,121 @@ class private_docs_agent:
         #print("#1", query)
         #print("#1", num_queries)
         #print("#1", query_historic)
-        results = self.collection.query(
-        query_texts=[query], # Chroma will embed this for you
-        n_results=5 # how many results to return
-            )
+        start = time.perf_counter()
+        results = self.retrieve_batch([query], n_results=top_k)[0]
         print("#6")
 
-        
-        report_final = ""
-        
-        # 
-        for i in range(len(results['metadatas'][0])):
-            meta = results['metadatas'][0][i]
-            doc = results['documents'][0][i]
-            referencia = f"page {meta['page']}"
-            texto_meta = meta['file_name']
-            texto_doc = doc
-            
-            # Crear la entrada en el reporte final
-            report_final += f"Reference number {i+1}: {texto_meta}, Text {referencia}: {texto_doc}\n"
-        
-        
-        
-        #print(report_final)
-
-        # Assuming `results` is the dictionary returned from the ChromaDB query
-        # and `results['documents']` is a list of strings
-        #documents = results['documents'][0]
-        
-        # Join all the strings in the list into a single string
-        #combined_answer = ' '.join(documents)
-        
-        
-
-        #print("#888 ", state['context'])
-        new_context = "" + str(state['context']) + "\n"
-        
-        # Concatenate the results to the existing context
-        new_context += report_final
+        # a chunk already retrieved by an earlier query is kept once, with its best score
+        chunks = merge_chunks(state["chunks"], results_to_chunks(results))
+        record(retrieval_ms=round((time.perf_counter() - start) * 1000, 1), hits=len(results["ids"]), new_chunks=len(chunks) - len(state["chunks"]))
 
         # Increment the search counter
         num_queries += 1
-        #print("#999 ", new_context, num_queries, query_historic)
-        # Return the updated context and the query count
-        return {"context": new_context, "num_queries": num_queries,"query_historic":query_historic}
+        return {"chunks": chunks, "num_queries": num_queries,"query_historic":query_historic}
+
+
 
+    def warm_up(self, startup_timer=None):
+        """
+        Load the embedding model and the vector index before the first request instead of during it
+        """
+        with optional_phase(startup_timer, "warm up embedder"):
+            embedding = self.embedding_cache.embedding_function(["warm up"])
+        with optional_phase(startup_timer, "warm up index"):
+            self.retriever.query(embedding, n_results=1)
+
+    def retrieve_batch(self, queries, n_results=5):
+        """
+        Retrieve chunks for several queries with one embedding batch and one collection query
+        (with a document index, one per distinct set of selected files)
+
+        Args:
+            queries (list): natural language queries
+            n_results (int): how many chunks to return per query
+
+        Returns:
+            list: one result dict per query with 'ids', 'metadatas', 'documents' and 'distances'
+        """
+        if not queries:
+            return []
+        query_embeddings = self.embedding_cache.embed(queries)
+        over_fetch = self.rerank is not None or self.hybrid
+        fetch_k = max(n_results, self.rerank_fetch_k) if over_fetch else n_results
+        files = [None] * len(queries)
+        if self.document_index is None:
+            results = self.retriever.query(query_embeddings, n_results=fetch_k, include_embeddings=over_fetch)
+        else:
+            # each query only searches the chunks of its own top files, queries that selected the same files share a call
+            files = self.document_index.select(query_embeddings, self.top_files)
+            groups = defaultdict(list)
+            for i, names in enumerate(files):
+                groups[tuple(sorted(names))].append(i)
+            results = [None] * len(queries)
+            for names, indices in groups.items():
+                group = self.retriever.query([query_embeddings[i] for i in indices], n_results=fetch_k,
+                                             where={"file_name": {"$in": list(names)}}, include_embeddings=over_fetch)
+                for i, result in zip(indices, group):
+                    results[i] = result
+
+        batch = []
+        for i, result in enumerate(results):
+            if self.hybrid:
+                result = self._fuse_lexical(queries[i], query_embeddings[i], result, files[i])
+            if self.rerank == "mmr":
+                selected = mmr_select(query_embeddings[i], result["embeddings"], n_results, self.mmr_lambda)
+            elif self.rerank == "file_cap":
+                selected = cap_per_file(result["metadatas"], n_results, self.max_chunks_per_file)
+            else:
+                selected = range(min(n_results, len(result["ids"])))
+            result = {key: [values[j] for j in selected] for key, values in result.items() if key != "embeddings"}
+            batch.append(result)
+        return batch
 
+    def _fuse_lexical(self, query, query_embedding, result, files=None):
+        """
+        Reciprocal rank fusion of the vector candidates with the BM25 hits of the same query,
+        chunks only found by BM25 are fetched from the collection and get their vector distance computed
+        (and dropped when files is given and they belong to another file)
+        """
+        lexical_ids = [chunk_id for chunk_id, _score in self.bm25_index.search(query, self.rerank_fetch_k)]
+        fused_ids = reciprocal_rank_fusion([result["ids"], lexical_ids])[:self.rerank_fetch_k]
+
+        known = {chunk_id: j for j, chunk_id in enumerate(result["ids"])}
+        fetched = {}
+        missing = [chunk_id for chunk_id in fused_ids if chunk_id not in known]
+        if missing:
+            extra = self.retriever.get(missing)
+            distances = self._distances(query_embedding, extra["embeddings"])
+            for j, chunk_id in enumerate(extra["ids"]):
+                if files is not None and extra["metadatas"][j]["file_name"] not in files:
+                    continue
+                fetched[chunk_id] = {"ids": chunk_id, "metadatas": extra["metadatas"][j], "documents": extra["documents"][j],
+                                     "distances": distances[j], "embeddings": extra["embeddings"][j]}
+
+        fused = {key: [] for key in result}
+        for chunk_id in fused_ids:
+            if chunk_id in known:
+                for key in result:
+                    fused[key].append(result[key][known[chunk_id]])
+            elif chunk_id in fetched:
+                for key in result:
+                    fused[key].append(fetched[chunk_id][key])
+        return fused
+
+    def _distances(self, query_embedding, embeddings):
+        # same metric the collection's HNSW index reports
+        space = self.retriever.space
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if space == "l2":
+            return [float(d) for d in ((vectors - query) ** 2).sum(axis=1)]
+        if space == "cosine":
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+            return [float(d) for d in 1 - (vectors @ query) / np.maximum(norms, 1e-12)]
+        return [float(d) for d in 1 - vectors @ query]
+
+    def render_context(self, state):
+        return render_context(state.get("chunks") or [], self.context_token_budget)
 
     def reject_question(self,state):
         
@@ -302,25 +511,81 @@ class private_docs_agent:
 
     def init_agent(self,state):
         #print("#init agent")
-        return {"num_queries": 0,"query_historic":"","context":"","next_action":""}
-
-
+        # a follow-up in a session starts from the chunks and queries of the earlier turns, anything else from nothing
+        chunks = state.get("chunks") or []
+        query_historic = state.get("query_historic") or ""
+        prefetched = state.get("prefetched_results")
+        if not prefetched and self.speculative_retrieval:
+            start = time.perf_counter()
+            prefetched = self.retrieve_batch([state["question"]])[0]
+            record(retrieval_ms=round((time.perf_counter() - start) * 1000, 1), hits=len(prefetched["ids"]))
+        if prefetched:
+            # first retrieval round was already done, in a batch by the caller or speculatively on the question
+            return {"num_queries": 1,"query_historic":query_historic + "\n" + state["question"],"chunks":merge_chunks(chunks, results_to_chunks(prefetched)),"next_action":""}
+        return {"num_queries": 0,"query_historic":query_historic,"chunks":chunks,"next_action":""}
+
+
+
+    def after_init(self,state):
+        if self.topology == "fused":
+            return "plan_next_step"
+        # with a first round of chunks already retrieved the next step is judging them, not asking for a query
+        return "reflect_on_answer" if state["chunks"] else "analyze_doc"
 
     def reflect_on_answer(self,state):
         # Retrieve the necessary information from the state
-        context = state["context"]
+        context = self.render_context(state)
         question = state["question"]
 
-        reflect_result = self.reflect_chain.invoke({"question": question,"context": context})
+        draft = self._start_draft(state.get("trace"), question, context)
+
+        reflect_result = self.reflect_chain.invoke({"question": question,"context": context}, config=llm_config())
         print("#reflection results: ",reflect_result)
         next_action = reflect_result["choice"]
         observations = reflect_result["justification"]
 
-        return {"next_action": next_action,"observations":observations}
+        return {"next_action": next_action,"observations":observations,"draft":self._settle_draft(draft, next_action, state["num_queries"])}
+
+    def plan_next_step(self,state):
+        # fused topology: one call judges the context and writes the next query
+        question = state["question"]
+        context = self.render_context(state)
+        draft = self._start_draft(state.get("trace"), question, context) if state["chunks"] else None
+
+        plan = self.plan_step_chain.invoke({"question": question,"context": context,"query_historic":state["query_historic"],"observations":state.get("observations") or ""}, config=llm_config())
+        next_action = plan["choice"]
+        update = {"next_action": next_action,"query": plan.get("query") or question,"observations": plan.get("justification", ""),
+                  "draft": self._settle_draft(draft, next_action, state["num_queries"])}
+        if next_action == "reanalize_doc":
+            update["chunks"] = []
+        return update
+
+    def _start_draft(self, trace, question, context):
+        if not self.speculative_generation:
+            return None
+        # its own span, the draft's LLM call must not count in the span of the decision running next to it
+        span = trace.start_span("speculative_answer", kind="draft") if trace is not None else None
+        config = llm_config(span) if span is not None else None
+        return SpeculativeDraft(self.draft_answer_chain, {"context": context, "question": question}, config, span)
+
+    def _settle_draft(self, draft, next_action, num_queries):
+        # kept when the graph answers on the context it was started with: the decision is to answer, or no query
+        # is left and the decision does not throw the context away (add_more_context ends in generate_answer too)
+        if draft is None:
+            return None
+        if next_action == "generate_answer" or (num_queries >= self.max_queries and next_action != "reanalize_doc"):
+            record(speculative="hit")
+            if draft.span is not None:
+                draft.span.set(decision="hit")
+            return draft
+        draft.cancel()
+        record(speculative="miss")
+        if draft.span is not None:
+            draft.span.set(decision="miss")
+        return None
 
     def reanalize_doc(self,state):
-        context = ""
-        return {"context": context}
+        return {"chunks": []}
 
     def add_more_context(self,state):
         return
@@ -332,7 +597,7 @@ class private_docs_agent:
         print("#3 can query",analysis_choice)
         if analysis_choice == "query_semantic_db":
             print("#4 can query")
-            if num_queries >= 2:
+            if num_queries >= self.max_queries:
                 return "generate_answer"
             else:
                 return analysis_choice    
@@ -341,6 +606,17 @@ class private_docs_agent:
 
 
 
+    def check_plan(self,state):
+        if state["next_action"] == "generate_answer" or state["num_queries"] >= self.max_queries:
+            return "generate_answer"
+        return "query_semantic_db"
+
+    def after_query(self,state):
+        # out of queries the only possible decision is to answer, skip the call that would make it
+        if state["num_queries"] >= self.max_queries:
+            return "generate_answer"
+        return "plan_next_step"
+
     def check_retrieval(self,state):
         next_action = state["next_action"]
 
@@ -349,9 +625,147 @@ class private_docs_agent:
 
         return next_action
     
-    def ask_question(self, par_state):
-        answer = self.local_agent.invoke(par_state)['generation']
+    def collection_fingerprint(self):
+        """
+        Changes whenever documents are added, removed or rewritten in the collection, used to invalidate cached answers
+        """
+        return self.retriever.fingerprint()
+
+    def _lookup_answer(self, question, trace):
+        if self.answer_cache is None:
+            return None, None
+        embedding = self.embedding_cache.embed([normalize_query(question)])[0]
+        answer = self.answer_cache.lookup(embedding, self.collection_fingerprint())
+        trace.set(answer_cache_hit=answer is not None)
+        return answer, embedding
+
+    def _store_answer(self, question, embedding, answer):
+        if self.answer_cache is not None:
+            self.answer_cache.store(normalize_query(question), embedding, answer, self.collection_fingerprint())
+
+    def _session_state(self, par_state, session):
+        if session is None or not session.has_history():
+            return par_state
+        return {**par_state, **session.initial_state(), "question": session.contextualize(par_state["question"])}
+
+    def _record_turn(self, session, par_state, answer, final_state):
+        if session is not None:
+            session.add_turn(par_state["question"], answer, final_state.get("chunks") or [], final_state.get("query_historic") or "")
+
+    def ask_question(self, par_state, session=None):
+        """
+        Args:
+            par_state (dict): initial graph state, at least 'question'
+            session (ConversationSession): optional conversation the question belongs to, its earlier turns are reused
+                and this one is added to it
+
+        Returns:
+            str: final answer
+        """
+        trace = self.tracer.start("private_docs", par_state["question"], par_state.get("parent_run_id"))
+        # a follow-up depends on its conversation: no cached answers and no sharing a run with other callers
+        follow_up = session is not None and session.has_history()
+        cached, embedding = (None, None) if follow_up else self._lookup_answer(par_state["question"], trace)
+        if cached is not None:
+            trace.finish()
+            self._record_turn(session, par_state, cached, {})
+            return cached
+
+        final_state = {}
+        # set when this caller runs the graph, not when the same question in flight from another caller answers it
+        ran = []
+
+        def run():
+            ran.append(True)
+            final_state.update(self.local_agent.invoke({**self._session_state(par_state, session), "trace": trace}))
+            answer = final_state['generation']
+            if not follow_up:
+                self._store_answer(par_state["question"], embedding, answer)
+            return answer
+
+        try:
+            answer = run() if follow_up else self.single_flight.do(normalize_query(par_state["question"]), run)
+        except Exception as e:
+            trace.finish(error=repr(e), coalesced=not ran)
+            raise
+        trace.finish(follow_up=follow_up, coalesced=not ran)
+        self._record_turn(session, par_state, answer, final_state)
         return answer        
 
+    def ask_question_stream(self, par_state, stats=None, session=None):
+        """
+        Run the agent and yield the final answer token by token as it is generated
 
+        Args:
+            par_state (dict): initial graph state, same as ask_question
+            stats (dict): optional dict filled with 'time_to_first_token', 'total_time' and 'num_tokens' (seconds)
+                and 'trace', the summary of the run trace
+            session (ConversationSession): optional conversation, same as ask_question
 
+        Yields:
+            str: answer tokens
+        """
+        stats = {} if stats is None else stats
+        token_queue = queue.Queue()
+        errors = []
+        key = normalize_query(par_state["question"])
+        trace = self.tracer.start("private_docs", par_state["question"], par_state.get("parent_run_id"))
+        follow_up = session is not None and session.has_history()
+
+        def run(call):
+            # finishes the single flight call itself, waiting duplicates do not depend on this generator being consumed
+            try:
+                final_state = self.local_agent.invoke({**self._session_state(par_state, session), "token_queue": token_queue, "trace": trace})
+                answer = final_state['generation']
+                if call is not None:
+                    self._store_answer(par_state["question"], embedding, answer)
+                    self.single_flight.finish(key, call, result=answer)
+                self._record_turn(session, par_state, answer, final_state)
+                stats["trace"] = trace.finish(follow_up=follow_up)
+            except Exception as e:
+                errors.append(e)
+                if call is not None:
+                    self.single_flight.finish(key, call, error=e)
+                stats["trace"] = trace.finish(error=repr(e))
+            finally:
+                token_queue.put(None)
+
+        start = time.perf_counter()
+        stats["num_tokens"] = 0
+        cached, embedding = (None, None) if follow_up else self._lookup_answer(par_state["question"], trace)
+        if follow_up:
+            threading.Thread(target=run, args=(None,), daemon=True).start()
+        elif cached is None:
+            leader, call = self.single_flight.join(key)
+            if leader:
+                threading.Thread(target=run, args=(call,), daemon=True).start()
+            else:
+                # the same question is already being answered, its full answer arrives as one chunk
+                try:
+                    cached = self.single_flight.wait(call)
+                except Exception as e:
+                    # the run answering it failed, this caller gets the same error
+                    stats["trace"] = trace.finish(error=repr(e), coalesced=True)
+                    raise
+                stats["trace"] = trace.finish(coalesced=True)
+        else:
+            stats["trace"] = trace.finish()
+        if cached is not None:
+            self._record_turn(session, par_state, cached, {})
+            token_queue.put(cached)
+            token_queue.put(None)
+
+        answer = ""
+        while True:
+            token = token_queue.get()
+            if token is None:
+                break
+            if stats["num_tokens"] == 0:
+                stats["time_to_first_token"] = time.perf_counter() - start
+            stats["num_tokens"] += 1
+            answer += token
+            yield token
+        stats["total_time"] = time.perf_counter() - start
+
+        if errors:
+            raise errors[0]
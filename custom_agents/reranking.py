@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def mmr_select(query_embedding, embeddings, k, lambda_mult=0.5):
+    """
+    Maximal marginal relevance: pick candidates relevant to the query but dissimilar to the ones already picked
+
+    Args:
+        query_embedding (list): query vector
+        embeddings (list): candidate vectors, best match first
+        k (int): how many candidates to keep
+        lambda_mult (float): 1 ranks purely by relevance, 0 purely by diversity
+
+    Returns:
+        list: indices of the selected candidates, in selection order
+    """
+    if len(embeddings) == 0:
+        return []
+    candidates = np.asarray(embeddings, dtype=np.float32)
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / max(np.linalg.norm(query), 1e-12)
+
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(k, len(candidates)):
+        redundancy = pairwise[:, selected].max(axis=1)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return selected
+
+
+def cap_per_file(metadatas, k, max_per_file=2):
+    """
+    Keep the best candidates while allowing at most max_per_file chunks of the same file_name
+
+    Args:
+        metadatas (list): candidate metadatas, best match first
+        k (int): how many candidates to keep
+
+    Returns:
+        list: indices of the selected candidates, best match first
+    """
+    selected = []
+    per_file = {}
+    for i, meta in enumerate(metadatas):
+        file_name = meta["file_name"]
+        if per_file.get(file_name, 0) >= max_per_file:
+            continue
+        per_file[file_name] = per_file.get(file_name, 0) + 1
+        selected.append(i)
+        if len(selected) == k:
+            break
+    return selected
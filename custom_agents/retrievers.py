@@ -0,0 +1,300 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def import_chromadb():
+    """
+    Import chromadb, swapping in pysqlite3 first since chroma needs a newer sqlite than some hosts ship
+    """
+    if "chromadb" not in sys.modules:
+        __import__('pysqlite3')
+        sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+    import chromadb
+    return chromadb
+
+
+class ChromaRetriever:
+    """
+    Retriever over a chroma persistent collection.
+
+    Every retriever returns, per query embedding, a dict with 'ids', 'metadatas', 'documents', 'distances'
+    (and 'embeddings' when asked), best match first, with distances in the collection's hnsw:space.
+    """
+    def __init__(self, persist_path="./docsdb2", collection_name="private_docs"):
+        chromadb = import_chromadb()
+        self.persist_path = persist_path
+        self.client = chromadb.PersistentClient(path=persist_path)
+        self.collection = self.client.get_collection(collection_name)
+        self.space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+
+    def query(self, query_embeddings, n_results, where=None, include_embeddings=False):
+        include = ["metadatas", "documents", "distances"]
+        if include_embeddings:
+            include.append("embeddings")
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where,
+            include=include,
+        )
+        return [{key: results[key][i] for key in ["ids"] + include} for i in range(len(query_embeddings))]
+
+    def get(self, ids, include_embeddings=True):
+        include = ["metadatas", "documents"] + (["embeddings"] if include_embeddings else [])
+        return self.collection.get(ids=ids, include=include)
+
+    def scan(self, batch_size=1000, include_embeddings=False):
+        """
+        Yields every chunk of the collection in batches of dicts with 'ids', 'metadatas', 'documents' (and 'embeddings')
+        """
+        include = ["metadatas", "documents"] + (["embeddings"] if include_embeddings else [])
+        for offset in range(0, self.collection.count(), batch_size):
+            yield self.collection.get(include=include, limit=batch_size, offset=offset)
+
+    def count(self):
+        return self.collection.count()
+
+    def fingerprint(self):
+        """
+        Changes whenever documents are added, removed or rewritten in the collection, used to invalidate caches
+        """
+        try:
+            mtime = os.path.getmtime(os.path.join(self.persist_path, "chroma.sqlite3"))
+        except OSError:
+            mtime = None
+        return (str(self.collection.id), self.collection.count(), mtime)
+
+
+class ShardedRetriever:
+    """
+    Several retrievers (e.g. chroma collections split by domain, possibly in different persist directories)
+    searched as one: every query is fanned out to all shards concurrently and the per shard hits are
+    merged into one global top n_results by distance.
+
+    Shards must be embedded with the same model and use the same distance space; chunk ids are expected
+    to be unique across shards.
+    """
+    def __init__(self, retrievers, max_workers=None):
+        self.shards = list(retrievers)
+        spaces = {shard.space for shard in self.shards}
+        if len(spaces) != 1:
+            raise ValueError(f"shards must share one distance space, got {sorted(spaces)}")
+        self.space = spaces.pop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(self.shards))
+
+    def query(self, query_embeddings, n_results, where=None, include_embeddings=False):
+        per_shard = self._map(lambda shard: shard.query(query_embeddings, n_results, where=where, include_embeddings=include_embeddings))
+        batch = []
+        for i in range(len(query_embeddings)):
+            results = [shard_results[i] for shard_results in per_shard]
+            keys = list(results[0])
+            hits = [(distance, r, j) for r, result in enumerate(results) for j, distance in enumerate(result["distances"])]
+            best = sorted(hits, key=lambda hit: hit[0])[:n_results]
+            batch.append({key: [results[r][key][j] for _distance, r, j in best] for key in keys})
+        return batch
+
+    def get(self, ids, include_embeddings=True):
+        merged = {}
+        for result in self._map(lambda shard: shard.get(ids, include_embeddings=include_embeddings)):
+            for key in ["ids", "metadatas", "documents"] + (["embeddings"] if include_embeddings else []):
+                values = result[key]
+                merged.setdefault(key, []).extend(list(values) if values is not None else [])
+        return merged
+
+    def scan(self, batch_size=1000, include_embeddings=False):
+        for shard in self.shards:
+            yield from shard.scan(batch_size, include_embeddings)
+
+    def count(self):
+        return sum(shard.count() for shard in self.shards)
+
+    def fingerprint(self):
+        return tuple(shard.fingerprint() for shard in self.shards)
+
+    def _map(self, fn):
+        if len(self.shards) == 1:
+            return [fn(self.shards[0])]
+        return list(self.executor.map(fn, self.shards))
+
+
+class NumpyRetriever:
+    """
+    Exact search by a matrix product over a memory-mapped embedding matrix exported from a collection.
+
+    Embeddings are float32 or int8 with one scale per row; metadata is kept as compact columns
+    (file name codes, pages, utf-8 blobs with offsets for ids and documents), only 'file_name' and 'page' are kept.
+    """
+    def __init__(self, path, block_size=8192):
+        self.path = path
+        self.block_size = block_size
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.space = self.meta["space"]
+        self.file_names = self.meta["file_names"]
+        self.quantized = self.meta["dtype"] == "int8"
+        if self.quantized:
+            self.embeddings = np.load(os.path.join(path, "embeddings_int8.npy"), mmap_mode="r")
+            self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        else:
+            self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.sq_norms = np.load(os.path.join(path, "sq_norms.npy"), mmap_mode="r")
+        self.file_codes = np.load(os.path.join(path, "file_codes.npy"), mmap_mode="r")
+        self.pages = np.load(os.path.join(path, "pages.npy"), mmap_mode="r")
+        self.ids = _StringColumn(path, "ids")
+        self.documents = _StringColumn(path, "documents")
+        self._rows_by_id = None
+        self._lock = threading.Lock()
+
+    def query(self, query_embeddings, n_results, where=None, include_embeddings=False):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        distances = self._distances(queries)
+        mask = self._where_mask(where)
+        if mask is not None:
+            distances[~mask] = np.inf
+
+        batch = []
+        for i in range(len(queries)):
+            k = min(n_results, len(distances) if mask is None else int(mask.sum()))
+            if k == 0:
+                rows = np.array([], dtype=np.int64)
+            else:
+                rows = np.argpartition(distances[:, i], k - 1)[:k]
+                rows = rows[np.argsort(distances[rows, i])]
+            result = self._rows(rows, include_embeddings)
+            result["distances"] = [float(d) for d in distances[rows, i]]
+            batch.append(result)
+        return batch
+
+    def get(self, ids, include_embeddings=True):
+        rows_by_id = self._id_index()
+        return self._rows(np.array([rows_by_id[chunk_id] for chunk_id in ids if chunk_id in rows_by_id], dtype=np.int64), include_embeddings)
+
+    def scan(self, batch_size=1000, include_embeddings=False):
+        for start in range(0, self.count(), batch_size):
+            yield self._rows(np.arange(start, min(start + batch_size, self.count())), include_embeddings)
+
+    def count(self):
+        return len(self.pages)
+
+    def fingerprint(self):
+        return ("numpy", self.meta["fingerprint"], self.count())
+
+    def _distances(self, queries):
+        # blocks bound the temporary float32 copy of int8 rows
+        dots = np.empty((self.count(), len(queries)), dtype=np.float32)
+        for start in range(0, self.count(), self.block_size):
+            end = start + self.block_size
+            block = np.asarray(self.embeddings[start:end], dtype=np.float32)
+            dots[start:end] = block @ queries.T
+            if self.quantized:
+                dots[start:end] *= self.scales[start:end, None]
+
+        query_sq_norms = (queries ** 2).sum(axis=1)
+        if self.space == "l2":
+            return np.asarray(self.sq_norms)[:, None] - 2 * dots + query_sq_norms[None, :]
+        if self.space == "cosine":
+            norms = np.sqrt(np.asarray(self.sq_norms))[:, None] * np.sqrt(query_sq_norms)[None, :]
+            return 1 - dots / np.maximum(norms, 1e-12)
+        return 1 - dots
+
+    def _where_mask(self, where):
+        if not where:
+            return None
+        if list(where) != ["file_name"]:
+            raise ValueError(f"NumpyRetriever only filters on file_name, got {where}")
+        condition = where["file_name"]
+        if isinstance(condition, str):
+            condition = {"$eq": condition}
+        if "$eq" in condition:
+            names = [condition["$eq"]]
+        elif "$in" in condition:
+            names = condition["$in"]
+        else:
+            raise ValueError(f"NumpyRetriever supports $eq and $in on file_name, got {condition}")
+        codes = [self.file_names.index(name) for name in names if name in self.file_names]
+        return np.isin(self.file_codes, codes)
+
+    def _rows(self, rows, include_embeddings):
+        result = {
+            "ids": [self.ids[row] for row in rows],
+            "metadatas": [{"file_name": self.file_names[self.file_codes[row]], "page": int(self.pages[row])} for row in rows],
+            "documents": [self.documents[row] for row in rows],
+        }
+        if include_embeddings:
+            embeddings = np.asarray(self.embeddings[rows], dtype=np.float32)
+            if self.quantized:
+                embeddings *= np.asarray(self.scales[rows])[:, None]
+            result["embeddings"] = embeddings.tolist()
+        return result
+
+    def _id_index(self):
+        with self._lock:
+            if self._rows_by_id is None:
+                self._rows_by_id = {self.ids[row]: row for row in range(self.count())}
+            return self._rows_by_id
+
+
+class _StringColumn:
+    """
+    Strings stored as one memory-mapped utf-8 blob plus an offsets array
+    """
+    def __init__(self, path, name):
+        self.blob = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, f"{name}_offsets.npy"), mmap_mode="r")
+
+    def __getitem__(self, row):
+        return bytes(self.blob[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    @staticmethod
+    def write(path, name, values):
+        encoded = [value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+        np.save(os.path.join(path, f"{name}.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, f"{name}_offsets.npy"), offsets)
+
+
+def export_collection(retriever, out_dir, dtype="float32"):
+    """
+    Export a ChromaRetriever's collection into the column files read by NumpyRetriever
+
+    Args:
+        retriever (ChromaRetriever): source collection
+        out_dir (str): destination folder
+        dtype (str): 'float32' or 'int8' (symmetric per row quantization)
+    """
+    ids, documents, file_codes, pages, embeddings = [], [], [], [], []
+    file_names = {}
+    for batch in retriever.scan(include_embeddings=True):
+        ids.extend(batch["ids"])
+        documents.extend(batch["documents"])
+        for meta in batch["metadatas"]:
+            file_codes.append(file_names.setdefault(meta["file_name"], len(file_names)))
+            pages.append(meta["page"])
+        embeddings.extend(batch["embeddings"])
+
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    np.save(os.path.join(out_dir, "sq_norms.npy"), (embeddings ** 2).sum(axis=1).astype(np.float32))
+    if dtype == "int8":
+        scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127.0
+        np.save(os.path.join(out_dir, "embeddings_int8.npy"), np.round(embeddings / scales[:, None]).astype(np.int8))
+        np.save(os.path.join(out_dir, "scales.npy"), scales.astype(np.float32))
+    else:
+        np.save(os.path.join(out_dir, "embeddings.npy"), embeddings)
+    np.save(os.path.join(out_dir, "file_codes.npy"), np.asarray(file_codes, dtype=np.int32))
+    np.save(os.path.join(out_dir, "pages.npy"), np.asarray(pages, dtype=np.int32))
+    _StringColumn.write(out_dir, "ids", ids)
+    _StringColumn.write(out_dir, "documents", documents)
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({
+            "space": retriever.space,
+            "dtype": dtype,
+            "fingerprint": list(retriever.fingerprint()),
+            "file_names": list(file_names),
+        }, f)
@@ -0,0 +1,78 @@
+import threading
+
+from custom_agents.context_builder import estimate_tokens, render_chunk
+
+
+class ConversationSession:
+    """
+    What one conversation carries from a turn to the next: earlier questions and answers, the chunks
+    retrieved so far and the queries already asked, so a follow-up only retrieves what is new.
+
+    Chunks are bounded by token_budget (estimated tokens of their rendered references); when a turn
+    goes over it, the chunks first retrieved in the oldest turns are evicted first.
+    """
+    def __init__(self, token_budget=4000, max_turns=10, max_queries=20):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.max_queries = max_queries
+        self.turns = []
+        self.chunks = []
+        self.queries = []
+        self.turn_count = 0
+        self._lock = threading.Lock()
+
+    def has_history(self):
+        with self._lock:
+            return bool(self.turns)
+
+    def contextualize(self, question):
+        """
+        The question with the earlier ones appended, a follow-up like 'and for intraday?' means nothing on its own
+        """
+        with self._lock:
+            earlier = [q for q, _answer in self.turns[-3:]]
+        if not earlier:
+            return question
+        return f"{question} (follow-up to: {' / '.join(earlier)})"
+
+    def initial_state(self):
+        """
+        Graph state fields a follow-up starts from
+        """
+        with self._lock:
+            return {"chunks": list(self.chunks), "query_historic": "".join("\n" + query for query in self.queries)}
+
+    def add_turn(self, question, answer, chunks, query_historic):
+        """
+        Record a finished turn, the chunks and query historic of its final graph state replace the carried ones
+
+        Args:
+            question (str): question as the user asked it
+            answer (str): final answer
+            chunks (list): chunk records of the final state
+            query_historic (str): newline separated queries of the final state
+        """
+        with self._lock:
+            first_seen = {chunk["id"]: chunk.get("turn", self.turn_count) for chunk in self.chunks}
+            self.chunks = [{**chunk, "turn": first_seen.get(chunk["id"], self.turn_count)} for chunk in chunks]
+            self._evict()
+            self.queries = [query for query in query_historic.split("\n") if query][-self.max_queries:]
+            self.turns = (self.turns + [(question, answer)])[-self.max_turns:]
+            self.turn_count += 1
+
+    def memory_tokens(self):
+        with self._lock:
+            return sum(self._chunk_tokens(chunk) for chunk in self.chunks)
+
+    def _evict(self):
+        used = sum(self._chunk_tokens(chunk) for chunk in self.chunks)
+        # oldest turn first, within a turn the least relevant chunk first
+        for chunk in sorted(self.chunks, key=lambda chunk: (chunk["turn"], -chunk["distance"])):
+            if used <= self.token_budget:
+                break
+            self.chunks.remove(chunk)
+            used -= self._chunk_tokens(chunk)
+
+    @staticmethod
+    def _chunk_tokens(chunk):
+        return estimate_tokens(render_chunk(0, chunk))
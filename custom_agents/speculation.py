@@ -0,0 +1,54 @@
+import queue
+import threading
+import time
+
+
+class SpeculativeDraft:
+    """
+    Streams a chain in a background thread before it is known whether its output will be used.
+
+    The consumer either takes the tokens (already generated ones first, then live) or cancels the
+    draft, which stops reading the stream at the next token and closes it. A trace span, if given, gets
+    the draft's wall time when the stream ends.
+    """
+    def __init__(self, chain, inputs, config=None, span=None):
+        self.span = span
+        self.started = time.perf_counter()
+        self.finished = None
+        self.error = None
+        self._tokens = queue.Queue()
+        self._cancelled = threading.Event()
+        threading.Thread(target=self._run, args=(chain, inputs, config), daemon=True).start()
+
+    def _run(self, chain, inputs, config):
+        try:
+            for token in chain.stream(inputs, config=config):
+                if self._cancelled.is_set():
+                    break
+                self._tokens.put(token)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = time.perf_counter()
+            if self.span is not None:
+                self.span.set(wall_ms=round((self.finished - self.started) * 1000, 1))
+            self._tokens.put(None)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def tokens(self):
+        while True:
+            token = self._tokens.get()
+            if token is None:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+    def head_start_ms(self):
+        """
+        Generation time already done when the draft is taken, what the speculation saved
+        """
+        end = time.perf_counter() if self.finished is None else self.finished
+        return round((end - self.started) * 1000, 1)
@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """
+    Wall time of each named startup phase, in the order they ran
+    """
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+        print(f"#startup {name}: {seconds:.3f}s")
+
+    def total(self):
+        return sum(seconds for _name, seconds in self.phases)
+
+    def report(self):
+        lines = [f"{name:<24} {seconds:8.3f}s" for name, seconds in self.phases]
+        lines.append(f"{'total':<24} {self.total():8.3f}s")
+        return "\n".join(lines)
+
+
+@contextmanager
+def optional_phase(timer, name):
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from custom_agents.context_builder import estimate_tokens
+
+_current = threading.local()
+
+NODE_FIELDS = ["wall_ms", "llm_calls", "prompt_tokens", "completion_tokens", "retrieval_ms", "hits"]
+
+
+class Span:
+    """
+    One node or routing function execution: wall time plus the LLM and retrieval figures recorded while it ran
+    """
+    def __init__(self, name, kind="node", offset_ms=0.0):
+        self.data = {"node": name, "kind": kind, "offset_ms": round(offset_ms, 1)}
+        self._lock = threading.Lock()
+
+    def set(self, **fields):
+        with self._lock:
+            self.data.update(fields)
+
+    def add(self, **fields):
+        with self._lock:
+            for key, value in fields.items():
+                self.data[key] = self.data.get(key, 0) + value
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """
+    Adds the prompt and completion tokens of every LLM call to a span, from the provider's token_usage when
+    it reports one, else estimated from the prompt and the generated text (streamed calls)
+    """
+    def __init__(self, span):
+        self.span = span
+        self._prompt_tokens = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._prompt_tokens[run_id] = sum(estimate_tokens(str(message.content)) for batch in messages for message in batch)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._prompt_tokens[run_id] = sum(estimate_tokens(prompt) for prompt in prompts)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        estimated_prompt = self._prompt_tokens.pop(run_id, 0)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            self.span.add(llm_calls=1, prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0))
+        else:
+            text = "".join(generation.text for generations in response.generations for generation in generations)
+            self.span.add(llm_calls=1, prompt_tokens=estimated_prompt, completion_tokens=estimate_tokens(text))
+            self.span.set(tokens_estimated=True)
+
+
+class RunTrace:
+    """
+    Spans of one question answered by an agent, written as JSON lines (one per span plus a run summary) when finished
+    """
+    def __init__(self, tracer, agent, question, parent_run_id=None):
+        self.tracer = tracer
+        self.run_id = uuid.uuid4().hex[:12]
+        self.agent = agent
+        self.question = question
+        self.parent_run_id = parent_run_id
+        self.started_at = time.time()
+        self.spans = []
+        self.fields = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, kind="node"):
+        span = Span(name, kind, (time.perf_counter() - self._start) * 1000)
+        previous = getattr(_current, "span", None)
+        _current.span = span
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.set(wall_ms=round((time.perf_counter() - start) * 1000, 1))
+            _current.span = previous
+            with self._lock:
+                self.spans.append(span)
+
+    def start_span(self, name, kind="node"):
+        """
+        Span for work running on another thread, added to the trace right away, the caller sets its wall_ms
+        """
+        span = Span(name, kind, self.elapsed_ms())
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def set(self, **fields):
+        """
+        Run level fields, written in the run record along with the ones given to finish
+        """
+        with self._lock:
+            self.fields.update(fields)
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self._start) * 1000, 1)
+
+    def summary(self):
+        nodes = [dict(span.data) for span in sorted(self.spans, key=lambda span: span.data["offset_ms"])]
+        totals = {field: round(sum(node.get(field, 0) for node in nodes), 1) for field in NODE_FIELDS[1:]}
+        return {"run_id": self.run_id, "agent": self.agent, "question": self.question,
+                "total_ms": self.elapsed_ms(), **totals, "nodes": nodes}
+
+    def finish(self, **fields):
+        summary = self.summary()
+        with self._lock:
+            summary.update(self.fields)
+        summary.update(fields)
+        base = {"run_id": self.run_id, "agent": self.agent}
+        if self.parent_run_id:
+            base["parent_run_id"] = self.parent_run_id
+        records = [{"type": "span", **base, **node} for node in summary["nodes"]]
+        records.append({"type": "run", **base, "started_at": self.started_at,
+                        **{key: value for key, value in summary.items() if key != "nodes"}})
+        self.tracer.write(records)
+        return summary
+
+
+class Tracer:
+    """
+    Appends the traces of every run to a JSON lines file, or only keeps them in memory when path is None
+    """
+    def __init__(self, path="./docsdb2_cache/traces.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def start(self, agent, question, parent_run_id=None):
+        return RunTrace(self, agent, question, parent_run_id)
+
+    def write(self, records):
+        if not self.path:
+            return
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+
+def current_span():
+    return getattr(_current, "span", None)
+
+
+def record(**fields):
+    """
+    Set fields on the span of the node running in this thread, if it is traced
+    """
+    span = current_span()
+    if span is not None:
+        span.set(**fields)
+
+
+def llm_config(span=None):
+    """
+    Runnable config collecting the token usage of LLM calls into the given (or the current) span
+    """
+    span = span or current_span()
+    return {"callbacks": [TokenUsageHandler(span)]} if span is not None else None
+
+
+def traced_node(name, fn):
+    """
+    Graph node that runs fn inside a span of state['trace'] and appends its step and wall time to generation_log
+    """
+    def node(state):
+        trace = state.get("trace")
+        start = time.perf_counter()
+        if trace is None:
+            output = fn(state) or {}
+        else:
+            with trace.span(name) as span:
+                output = fn(state) or {}
+                for key in ("analysis_choice", "next_action"):
+                    if output.get(key):
+                        span.set(decision=output[key])
+        generation_log = output.get("generation_log", state.get("generation_log") or "")
+        return {**output, "generation_log": generation_log + f"Step: {name} ({(time.perf_counter() - start) * 1000:.0f} ms)\n"}
+    return node
+
+
+def traced_route(name, fn):
+    """
+    Conditional edge function whose decision (and LLM calls, if it makes any) is recorded as a span of state['trace']
+    """
+    def route(state):
+        trace = state.get("trace")
+        if trace is None:
+            return fn(state)
+        with trace.span(name, kind="route") as span:
+            decision = fn(state)
+            span.set(decision=decision)
+        return decision
+    return route
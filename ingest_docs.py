@@ -0,0 +1,316 @@
+"""
+Builds or extends the private_docs collection in ./docsdb2 from a folder of PDFs.
+
+Text is extracted page by page in a process pool, split into chunks carrying the 'file_name' and 'page'
+metadata used by private_docs_agent.query_semantic_db, embedded in large batches and upserted in bounded batches.
+
+A manifest with a content hash per source file and per chunk is kept next to the store, so a rerun only
+extracts changed files, only embeds new or changed chunks and deletes the chunks of removed files.
+Files are identified by their path relative to the source folder; a run only prunes the files that were
+ingested from the same folder, so ingesting another folder adds to the collection.
+
+    python ingest_docs.py path/to/pdfs --workers 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from custom_agents.retrievers import import_chromadb
+
+chromadb = import_chromadb()
+from chromadb.utils import embedding_functions
+
+
+def extract_chunks(path, chunk_size, chunk_overlap):
+    """
+    Runs in a worker process, reads one PDF page by page and splits every page into chunks
+
+    Returns:
+        tuple: (file_name, number of pages, list of (page, chunk index, text))
+    """
+    from PyPDF2 import PdfReader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    reader = PdfReader(path)
+    chunks = []
+    for page_number, page in enumerate(reader.pages, start=1):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            print(f"#ingest could not read page {page_number} of {path}: {e}")
+            continue
+        for index, chunk in enumerate(splitter.split_text(text)):
+            chunks.append((page_number, index, chunk))
+    return os.path.basename(path), len(reader.pages), chunks
+
+
+def chunk_id(source_key, page, index):
+    return f"{source_key}:{page}:{index}"
+
+
+def source_key(source_dir, path):
+    """
+    Path of a PDF relative to the folder it is ingested from, the same on every OS
+    """
+    return os.path.relpath(path, source_dir).replace(os.sep, "/")
+
+
+def chunk_hash(page, text):
+    return hashlib.sha256(f"{page}\n{text}".encode("utf-8")).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Content hashes of every indexed source file and of every chunk it produced
+
+    Layout: {"files": {source_key: {"source_dir", "chunking", "sha256", "size", "mtime", "chunks": {chunk_id: chunk_hash}}}}
+    where source_dir is the absolute folder the file was ingested from and chunking its [chunk_size, chunk_overlap]
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)["files"]
+
+    def is_unchanged(self, key, path, chunking):
+        entry = self.files.get(key)
+        # chunked with other settings, its chunks have to be rebuilt even if the file did not change
+        if entry is None or entry.get("chunking") != list(chunking):
+            return False
+        stat = os.stat(path)
+        # size and mtime match, skip hashing the whole file
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["sha256"] == file_hash(path):
+            entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+            return True
+        return False
+
+    def update_file(self, key, path, chunks, source_dir, chunking):
+        stat = os.stat(path)
+        self.files[key] = {
+            "source_dir": os.path.abspath(source_dir),
+            "chunking": list(chunking),
+            "sha256": file_hash(path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "chunks": chunks,
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def list_pdfs(source_dir):
+    return sorted(
+        os.path.join(root, name)
+        for root, _dirs, names in os.walk(source_dir)
+        for name in names
+        if name.lower().endswith(".pdf")
+    )
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    def add(self, stage, seconds, count):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + count
+
+    def report(self, units):
+        for stage, unit in units.items():
+            seconds = self.seconds.get(stage, 0.0)
+            count = self.counts.get(stage, 0)
+            rate = count / seconds if seconds else 0.0
+            print(f"{stage:<10} {count:>8} {unit:<7} {seconds:8.1f}s  {rate:10.1f} {unit}/s")
+
+
+class Ingestor:
+    """
+    Embeds and upserts chunks as they arrive, never holding more than one embedding batch in memory
+    """
+    def __init__(self, collection, embedding_function, timer, embed_batch_size=256):
+        self.collection = collection
+        self.embedding_function = embedding_function
+        self.timer = timer
+        self.embed_batch_size = embed_batch_size
+        self.pending = []
+        # callbacks waiting for the pending chunks to be upserted
+        self.on_flush = []
+        self.skipped = 0
+        self.embedded = 0
+        self.deleted = 0
+        self.failed = []
+
+    def add(self, key, file_name, chunks, previous_chunks=None, reembed=False):
+        """
+        Queue the chunks of one file whose hash differs from previous_chunks and delete the ones that disappeared,
+        with reembed every chunk is queued but the ones that disappeared are still deleted. Chunk ids are built
+        from the file's source key, the 'file_name' metadata is its base name
+
+        Returns:
+            dict: chunk id to chunk hash for the manifest
+        """
+        previous_chunks = previous_chunks or {}
+        hashes = {}
+        for page, index, text in chunks:
+            current_id = chunk_id(key, page, index)
+            hashes[current_id] = chunk_hash(page, text)
+            if not reembed and previous_chunks.get(current_id) == hashes[current_id]:
+                self.skipped += 1
+                continue
+            self.pending.append((current_id, text, {"file_name": file_name, "page": page}))
+            if len(self.pending) >= self.embed_batch_size:
+                self.flush()
+        self.delete([old_id for old_id in previous_chunks if old_id not in hashes])
+        return hashes
+
+    def when_flushed(self, callback):
+        """
+        Run callback once every chunk queued so far is in the collection
+        """
+        if self.pending:
+            self.on_flush.append(callback)
+        else:
+            callback()
+
+    def delete(self, ids):
+        if ids:
+            self.collection.delete(ids=ids)
+            self.deleted += len(ids)
+
+    def flush(self):
+        if not self.pending:
+            return
+        ids, documents, metadatas = (list(column) for column in zip(*self.pending))
+        self.pending = []
+
+        start = time.perf_counter()
+        embeddings = self.embedding_function(documents)
+        self.timer.add("embed", time.perf_counter() - start, len(documents))
+
+        start = time.perf_counter()
+        self.collection.upsert(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+        self.timer.add("upsert", time.perf_counter() - start, len(documents))
+        self.embedded += len(documents)
+        callbacks, self.on_flush = self.on_flush, []
+        for callback in callbacks:
+            callback()
+
+
+def ingest(source_dir, paths, collection, manifest, workers=4, chunk_size=1000, chunk_overlap=100, embed_batch_size=256, reembed=False):
+    timer = StageTimer()
+    ingestor = Ingestor(collection, embedding_functions.DefaultEmbeddingFunction(), timer, embed_batch_size)
+    chunking = (chunk_size, chunk_overlap)
+    keys = {path: source_key(source_dir, path) for path in paths}
+
+    start = time.perf_counter()
+    # only files ingested from this folder can have been removed, the ones of other folders are left alone
+    root = os.path.abspath(source_dir)
+    present = set(keys.values())
+    for key in [key for key, entry in manifest.files.items() if entry.get("source_dir") == root and key not in present]:
+        print(f"#ingest {key} was removed")
+        ingestor.delete(list(manifest.files.pop(key)["chunks"]))
+
+    changed = []
+    for path in paths:
+        if not reembed and manifest.is_unchanged(keys[path], path, chunking):
+            ingestor.skipped += len(manifest.files[keys[path]]["chunks"])
+        else:
+            changed.append(path)
+    print(f"#ingest {len(changed)} new or changed files, {len(paths) - len(changed)} unchanged")
+
+    # at most two files in flight per worker, so extracted text does not pile up while embedding lags behind
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            paths = iter(changed)
+
+            def submit_next():
+                path = next(paths, None)
+                if path is not None:
+                    pending[executor.submit(extract_chunks, path, chunk_size, chunk_overlap)] = path
+
+            for _ in range(workers * 2):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    submit_next()
+                    try:
+                        file_name, num_pages, chunks = future.result()
+                    except Exception as e:
+                        # an unreadable file keeps its previous manifest entry, if any, and is retried next run
+                        print(f"#ingest could not read {path}: {e!r}")
+                        ingestor.failed.append(path)
+                        continue
+                    timer.add("extract", 0.0, num_pages)
+                    timer.add("chunk", 0.0, len(chunks))
+                    key = keys[path]
+                    print(f"#ingest {key}: {num_pages} pages, {len(chunks)} chunks")
+                    previous = manifest.files.get(key, {}).get("chunks")
+                    hashes = ingestor.add(key, file_name, chunks, previous, reembed)
+                    # recorded only once its chunks are upserted, an interrupted run re-embeds what did not make it
+                    ingestor.when_flushed(lambda key=key, path=path, hashes=hashes:
+                                          manifest.update_file(key, path, hashes, source_dir, chunking))
+            ingestor.flush()
+    finally:
+        manifest.save()
+
+    elapsed = time.perf_counter() - start
+    # extraction runs in parallel with embedding, its throughput is measured against the whole run
+    timer.seconds["extract"] = timer.seconds["chunk"] = elapsed
+    return timer, elapsed, ingestor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source_dir", help="folder with the PDFs to index")
+    parser.add_argument("--persist-path", default="./docsdb2")
+    parser.add_argument("--collection", default="private_docs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--embed-batch-size", type=int, default=256)
+    parser.add_argument("--manifest", default="./docsdb2_cache/ingest_manifest.json")
+    parser.add_argument("--full", action="store_true", help="re-extract and re-embed every file, the manifest is still used to delete stale chunks")
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=args.persist_path)
+    collection = client.get_or_create_collection(args.collection)
+    paths = list_pdfs(args.source_dir)
+    print(f"#ingest {len(paths)} PDFs into {args.persist_path}/{args.collection}")
+
+    manifest = Manifest(args.manifest)
+    timer, elapsed, ingestor = ingest(args.source_dir, paths, collection, manifest, args.workers, args.chunk_size, args.chunk_overlap,
+                                      args.embed_batch_size, reembed=args.full)
+    print(f"#ingest done in {elapsed:.1f}s, collection has {collection.count()} chunks")
+    print(f"#ingest chunks skipped: {ingestor.skipped}, re-embedded: {ingestor.embedded}, deleted: {ingestor.deleted}")
+    if ingestor.failed:
+        print(f"#ingest {len(ingestor.failed)} files could not be read: {', '.join(ingestor.failed)}")
+    timer.report({"extract": "pages", "chunk": "chunks", "embed": "chunks", "upsert": "chunks"})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,50 @@
+import time
+_import_start = time.perf_counter()
+
 import streamlit as st
 import os
-from groq import Groq
-import random
-import sys
-import io
-import pandas as pd
 from custom_agents.private_docs_agent import private_docs_agent
-from langchain_groq import ChatGroq
+from custom_agents.startup_timer import StartupTimer
+from custom_agents.llm_scheduler import make_groq_llm
+from custom_agents.session import ConversationSession
+
+_import_seconds = time.perf_counter() - _import_start
 
 
-api_key = os.environ['GROQ_API_KEY']
-chat = ChatGroq(temperature=0, groq_api_key=api_key, model_name="llama3-70b-8192")
-print("#33 ",api_key,chat)
+@st.cache_resource
+def get_llm():
+    # one rate limited, pooled client shared by every chain and every rerun of the app,
+    # limits from GROQ_REQUESTS_PER_MINUTE / GROQ_TOKENS_PER_MINUTE
+    return make_groq_llm(os.environ['GROQ_API_KEY'], model_name="llama3-70b-8192", base_url=os.environ.get("GROQ_BASE_URL"))
 
+chat = get_llm()
 
 
 @st.cache_resource
 def get_private_docs_agent(_llm):
-    return private_docs_agent(_llm)
+    # built once per server process, warmed up so the first visitor does not load the embedder and index
+    startup_timer = StartupTimer()
+    startup_timer.add("imports", _import_seconds)
+    agent = private_docs_agent(_llm, speculative_retrieval=True, startup_timer=startup_timer)
+    agent.warm_up(startup_timer)
+    return agent, startup_timer
 
-private_docs_helper = get_private_docs_agent(chat)
+private_docs_helper, startup_timer = get_private_docs_agent(chat)
+
+TRACE_COLUMNS = ["node", "kind", "offset_ms", "wall_ms", "llm_calls", "prompt_tokens", "completion_tokens", "retrieval_ms", "hits", "decision"]
 
 def f_preguntar():
     pass #st.title("####1")
 
 
+def new_conversation():
+    # runs before the rerun, so the question still in the text input is not asked again in the new session
+    st.session_state.session = ConversationSession()
+    st.session_state.chat_history = []
+    st.session_state.last_message = None
+    st.session_state.userq = ""
+
+
 def main():
     """
     This function is the main entry point of the application. It sets up the Groq client, the Streamlit interface, and handles the chat interaction.
@@ -56,27 +76,46 @@ def main():
     st.sidebar.write('Example 6: information about pricing an IPO')
     st.sidebar.write('Example 7: notes about picking right stocks')
     st.sidebar.write('Document source: https://the-eye.eu/public/Books/cdn.preterhuman.net/texts/finance_and_marketing/stock_market/')
+    with st.sidebar.expander("Startup time"):
+        st.code(startup_timer.report())
+
+    # one conversation per browser session, follow-ups reuse the chunks already retrieved
+    if 'session' not in st.session_state:
+        new_conversation()
+    st.sidebar.button("New conversation", on_click=new_conversation)
+    session = st.session_state.session
+    st.sidebar.caption(f"Conversation memory: {len(session.chunks)} chunks, {session.memory_tokens()} tokens")
+
+    for past_question, past_answer in zip(st.session_state.chat_history[::2], st.session_state.chat_history[1::2]):
+        st.markdown(f"**{past_question}**")
+        st.markdown(past_answer)
+
     message = st.text_input("Ask the expert?:",on_change=f_preguntar,key = "userq")
 
-    if message:
-        
-        st.session_state.chat_history=[]
-        st.session_state.chat_history.append(message)
+    # streamlit reruns the script on every interaction, only a new message is a new turn
+    if message and message != st.session_state.last_message:
+        st.session_state.last_message = message
         #query = "check the internal microsoft report about revenue figures, add more recent values from internet and the plot it"
         query = message
         generation_log = f"Step: Init agent\n"
         info = "Step: Checking if question is about finance or investments\n"
         generation_log += info
 
-        output = private_docs_helper.ask_question({"question": query,"generation_log":generation_log})
+        stream_stats = {}
+        output = st.write_stream(private_docs_helper.ask_question_stream({"question": query,"generation_log":generation_log}, stats=stream_stats, session=session))
         #print("=======FINAL OUTPUT========", output["generation"])
         message_data = output
+        # question and answer together, a failed answer leaves the history pairs aligned
+        st.session_state.chat_history.extend([message, message_data])
         
+        if "time_to_first_token" in stream_stats:
+            st.caption(f"Time to first token: {stream_stats['time_to_first_token']:.2f}s, total: {stream_stats['total_time']:.2f}s")
+        if "trace" in stream_stats:
+            trace = stream_stats["trace"]
+            with st.expander(f"Trace: {trace['total_ms']:.0f} ms, {trace['llm_calls']:.0f} LLM calls, "
+                             f"{trace['prompt_tokens'] + trace['completion_tokens']:.0f} tokens"):
+                st.table([{column: node.get(column, "") for column in TRACE_COLUMNS} for node in trace["nodes"]])
 
-        st.write(message_data)
-
-       
-        st.session_state.chat_history.append(message_data)
   
     st.write ("<-- Links to the documents on the sidebar.")
     st.write ("List of indexed documents:")